@@ -33,9 +33,10 @@ import string
 # import getpass
 # from dkan.client import DatasetAPI
 import zipfile
+import concurrent.futures
 
 
-def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today):	
+def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today, max_table_workers=1, fetch_size=10000):	
 
 	################################################################# Controls #################################################################
 	# today = str(date.today())
@@ -76,6 +77,10 @@ def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today)
 
 
 
+	# R (through reticulate) passes numbers as doubles, so the counts are converted to int once, here
+	max_table_workers = int(max_table_workers)
+	fetch_size = int(fetch_size)
+
 	# decodeAndStrip takes a string and filters each character through the printable variable. It returns a filtered string.
 	def decodeAndStrip(t):
 		filter1 = ''.join(filter(lambda x: x in printable, str(t)))
@@ -254,19 +259,254 @@ def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today)
 	#########################        Dictionary of code fixer 	above	###########################
 	###########################################################################################################################
 
+	###########################################################################################################################
+	#########################        Data quality rules 	below	###########################
+	###########################################################################################################################
+
+	# compileDataQuality builds the data quality scoring of a table once, before its records are read. Each column of
+	# Mod_CodeColumns (see DictionaryFixer) becomes a (column, QA codes, split on commas, DQ rule) tuple. The DQ rule
+	# adds the numerical codes of a record's value to DQ, and the special rules (000NONPJ, surrogate, DNQ before 2008
+	# and ND) are picked here for their columns instead of being tested on every column of every record.
+	def compileDataQuality(Mod_CodeColumns, table):
+		rules = []
+		for codeCol, codeDict in Mod_CodeColumns.items():
+			codes = dict(codeDict)
+			if codeCol == 'QACode':
+				dqRule = qaCodeRule(codes)
+			elif codeCol == 'StationCode':
+				dqRule = stationCodeRule
+			elif codeCol == 'Analyte' or codeCol == 'AnalyteName':
+				dqRule = analyteRule
+			elif codeCol == 'ResultQualCode' or codeCol == 'ResQualCode':
+				dqRule = resultQualCodeRule(codes, table)
+			elif codeCol == 'Result':
+				dqRule = resultRule(codes)
+			else:
+				dqRule = codeRule(codes)
+			rules.append((codeCol, codes, codeCol == 'QACode', dqRule))
+		return rules
+
+	# codeRule is the rule for all of the non Special Rules columns: if the record's value is in the dictionary of QA
+	# codes, add its numerical code to DQ
+	def codeRule(codes):
+		def rule(codeVal, recordDict, DQ):
+			if codeVal in codes:
+				DQ.append(codes[codeVal])
+		return rule
+
+	# qaCodeRule splits the QACode value up by commas (ie. 'QAC,DNR,LOB') and adds the numerical code of each of them,
+	# and of the whole value, to DQ
+	def qaCodeRule(codes):
+		def rule(value, recordDict, DQ):
+			for codeVal in value.split(','):
+				if codeVal in codes:
+					DQ.append(codes[codeVal])
+			if value in codes:
+				DQ.append(codes[value])
+		return rule
+
+	# stationCodeRule adds 0 to DQ if a record has 000NONPJ or any variants in the StationCode value. The other
+	# StationCode codes are only reported in the quality indicator (as before, when the lookup used the value left
+	# over from the previous column, which is never a station code)
+	def stationCodeRule(value, recordDict, DQ):
+		if '000NONPJ' in value:
+			DQ.append(0)
+
+	# analyteRule searches for surrogate and marks DQ with a 0
+	surrogate = re.compile('[Ss]urrogate')
+	def analyteRule(value, recordDict, DQ):
+		if surrogate.search(value):
+			DQ.append(0)
+
+	# resultQualCodeRule holds the Special Rules for ResultQualCode. For both IR2018_WQ and IR2018_Tissue, a DNQ is
+	# a reject if the year is less than 2008, but dates for these datasets were reported as monthdayyear, so we need
+	# the last 4. For the other tables a DNQ before 2008 is a reject too. ND is a pass (the Result values are text, so
+	# the Benthic check for a positive result never applied). Everything else is looked up in the QA codes.
+	def resultQualCodeRule(codes, table):
+		def rule(codeVal, recordDict, DQ):
+			if table == 'IR2018_WQ' or table == 'IR2018_Tissue' and codeVal == 'DNQ':
+				if int(recordDict['SampleDate'][-4:]) < 2008:
+					DQ.append(6)
+			elif codeVal == 'DNQ' and int(recordDict['SampleDate'][:4]) < 2008:
+				DQ.append(6)
+			elif codeVal == 'ND':
+				DQ.append(1)
+			elif codeVal in codes:
+				DQ.append(codes[codeVal])
+		return rule
+
+	# resultRule looks up each character of the Result value, as before, so only single character codes can match
+	# (Result_list only holds '', which never does, so there is usually no rule at all)
+	def resultRule(codes):
+		charCodes = dict((codeVal, code) for codeVal, code in codes.items() if len(codeVal) == 1)
+		def rule(value, recordDict, DQ):
+			for codeVal in value:
+				if codeVal in charCodes:
+					DQ.append(charCodes[codeVal])
+		if charCodes:
+			return rule
+		return None
+
+	# scoreDataQuality fills in the DataQuality and DataQualityIndicator columns of a record in one pass over the
+	# rules from compileDataQuality. The codes of each value are saved on the way, so the quality indicator does
+	# not have to look them up again.
+	def scoreDataQuality(recordDict, rules):
+		DQ = []
+		matches = []
+		for codeCol, codes, splitValues, dqRule in rules:
+			value = recordDict[codeCol]
+			if dqRule is not None:
+				dqRule(value, recordDict, DQ)
+			if splitValues:
+				for codeVal in value.split(','):
+					if codeVal in codes:
+						matches.append((codeCol, codeVal, int(codes[codeVal])))
+			elif value in codes:
+				matches.append((codeCol, value, int(codes[value])))
+		if DQ:
+			MaxDQ = max(DQ)
+		else:
+			# if DQ doesn't have any values, it means that it slipped through the cracks
+			# and is some kind of an error. Check it out
+			MaxDQ = 7
+			DQ.append(MaxDQ)
+		# A word about that DQ variable.
+		# DQ might host a long list of numbers but if there is ever a zero, that whole
+		# record should be classified as a QC record. If there isnt a zero and the
+		# maximum value is a 1, then that record passed our data quality estimate
+		# unblemished. If there isn't a zero and the max DQ values is greater than 1,
+		# then ... we get the max value and store the corresponding value (from the
+		# DQ_Codes dictionary). If the Max DQ is 6 (which is a reject record) and QInd is
+		# empty, then this is a special rule case and we label it as such. Otherwise, we
+		# throw the codes equal to the max value of DQ into the Quality indicator column,
+		# ie. 'ResQualCode:npr,kqed; BatchVerificationCode:lol,btw,omg'
+		if min(DQ) == 0:
+			recordDict['DataQuality'] = DQ_Codes[0]
+		elif MaxDQ == 1:
+			recordDict['DataQuality'] = DQ_Codes[1]
+		else:
+			recordDict['DataQuality'] = DQ_Codes[MaxDQ]
+			QInd = []
+			lastCol = None
+			for codeCol, codeVal, code in matches:
+				if code == MaxDQ:
+					if codeCol == lastCol:
+						QInd[-1] += ',' + codeVal
+					else:
+						QInd.append(codeCol + ':' + codeVal)
+						lastCol = codeCol
+			if MaxDQ == 6 and QInd == []:
+				recordDict['DataQualityIndicator'] = 'ResultQualCode Special Rules'
+			else:
+				recordDict['DataQualityIndicator'] = '; '.join(QInd)
+	###########################################################################################################################
+	#########################        Data quality rules 	above	###########################
+	###########################################################################################################################
+
+	# YearPartitionRouter writes each record to the yearly file of its sample year. partitionName(year) returns the
+	# part of the file name for a year (ie. '_year-2023'), or None if records from that year do not go to a yearly
+	# file. Several years can share one file (ie. '_prior_to_2000'). A file is opened, and its header written, the
+	# first time a record for it comes up, so any range of years can be covered and no file is created for years
+	# without records. The files are added to writtenFiles (as filename + partition name) and are closed when the
+	# with block ends.
+	class YearPartitionRouter:
+		def __init__(self, filename, columns, partitionName, writtenFiles, saveLocation, sep, extension):
+			self.filename = filename
+			self.columns = columns
+			self.partitionName = partitionName
+			self.writtenFiles = writtenFiles
+			self.saveLocation = saveLocation
+			self.sep = sep
+			self.extension = extension
+			# open files by partition name, and the writer of every year seen so far (None if it has no file)
+			self.files = {}
+			self.writers = {}
+			self.yearWriters = {}
+
+		def __enter__(self):
+			return self
+
+		def __exit__(self, *exc_info):
+			self.close()
+
+		# getWriter returns the csv writer for a year, opening the file for the year if this is its first record
+		def getWriter(self, year):
+			partition = self.partitionName(year)
+			if partition is not None and partition not in self.writers:
+				path = os.path.join(self.saveLocation, '%s%s' % (self.filename + partition + "_" + today, self.extension))
+				csvfile = open(path, 'w', newline='', encoding='utf8')
+				dw = csv.DictWriter(csvfile, fieldnames=self.columns, delimiter=self.sep, lineterminator='\n')
+				dw.writeheader()
+				self.files[partition] = csvfile
+				self.writers[partition] = csv.writer(csvfile, csv.QUOTE_MINIMAL, delimiter=self.sep, lineterminator='\n')
+				self.writtenFiles[self.filename + partition] = path
+			self.yearWriters[year] = self.writers.get(partition)
+			return self.yearWriters[year]
+
+		# writerow writes the values of a record to the yearly file of its sample year
+		def writerow(self, year, values):
+			if year in self.yearWriters:
+				writer = self.yearWriters[year]
+			else:
+				writer = self.getWriter(year)
+			if writer is not None:
+				writer.writerow(values)
+
+		# writerows writes the values of a block of records, given as (year, values) pairs, to the yearly files of
+		# their sample years. The records are grouped by file, keeping their order, and each file gets one writerows
+		# call per block
+		def writerows(self, records):
+			fileRows = {}
+			for year, values in records:
+				if year in self.yearWriters:
+					writer = self.yearWriters[year]
+				else:
+					writer = self.getWriter(year)
+				if writer is not None:
+					fileRows.setdefault(writer, []).append(values)
+			for writer, rows in fileRows.items():
+				writer.writerows(rows)
+
+		# close closes the yearly files. Sometimes a file gets only a handful of records, so as before we erase
+		# files based on # of bytes which is 2000
+		def close(self):
+			for partition, csvfile in self.files.items():
+				csvfile.close()
+				path = self.writtenFiles[self.filename + partition]
+				if os.stat(path).st_size < 2000:
+					os.remove(path)
+					self.writtenFiles.pop(self.filename + partition)
+			self.files = {}
+			self.writers = {}
+			self.yearWriters = {}
+
 	# data_retrieval is the meat of this script. It takes the tables dictionary defined above, two dates (specified
 	# below), and a save location for the output files.
 	def data_retrieval(tables, saveLocation, sep, extension):
 		# initialize writtenFiles where we will store the output complete file paths in list format.
 		writtenFiles = {}
+		# connectDataMart opens a connection to the DataMart (see below)
+		def connectDataMart():
+			# cnxn = pyodbc.connect(Driver='SQL Server Native Client 11.0', Server=SERVER1, uid=UID, pwd=PWD)
+			return pyodbc.connect(Driver='SQL Server', Server=SERVER1, uid=UID, pwd=PWD)
+		# fetchBlocks returns the rows of the query run on cursor in blocks of fetch_size rows. Each block is fetched
+		# from the DataMart at once (with fetchmany and a matching arraysize) instead of one fetch per row, and
+		# retrieveTable (below) cleans up and writes out a whole block at a time, which cuts the driver and csv writer
+		# overhead for the tens of millions of rows in the larger tables
+		def fetchBlocks(cursor):
+			cursor.arraysize = fetch_size
+			while True:
+				rows = cursor.fetchmany(fetch_size)
+				if not rows:
+					break
+				yield rows
 		try:
 			# a python cursor is a synonym to a recordset or resultset.
 			# this is the connection to SWRCB internal DataMart. Server, IUD, PWD are set as environmental variables so
 			# no passwords are in plain text, see "Main" below for importing examples. UID
 			# below create a connection
 			# Please be sure that you have the 'ODBC Driver 11 for SQL Server' driver installed on your machine.
-			# cnxn = pyodbc.connect(Driver='SQL Server Native Client 11.0', Server=SERVER1, uid=UID, pwd=PWD)
-			cnxn = pyodbc.connect(Driver='SQL Server', Server=SERVER1, uid=UID, pwd=PWD)
+			cnxn = connectDataMart()
 			# creates a cursor which will execute the sql statement
 			cursor = cnxn.cursor()
 		except:
@@ -281,19 +521,12 @@ def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today)
 		prefix = '_year-'
 		# years = range(1989, cur_year + 1)
 		years = range(2023, 2035) # through 2034
-		# commonly used string for filename creation.
-		range_1 = prefix + str(years[0]) # 2023
-		range_2 = prefix + str(years[1]) # 2024
-		range_3 = prefix + str(years[2])
-		range_4 = prefix + str(years[3])
-		range_5 = prefix + str(years[4]) # 
-		range_6 = prefix + str(years[5]) 
-		range_7 = prefix + str(years[6]) 
-		range_8 = prefix + str(years[7])
-		range_9 = prefix + str(years[8])
-		range_10 = prefix + str(years[9]) # 
-		range_11 = prefix + str(years[10]) # 
-		range_12 = prefix + str(years[11]) # 
+		# yearPartition returns the part of the file name for the yearly file of a sample year, see
+		# YearPartitionRouter above. Every year in years gets its own file, so years can be any range.
+		def yearPartition(year):
+			if year in years:
+				return prefix + str(year)
+			return None
         
 		# get min/max date, used to build SQL query
 		min_year = min(years)
@@ -301,46 +534,25 @@ def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today)
 		max_year = max(years)
 		max_date = str(max_year + 1) + str("-01-01")
 		
-        # This loop iterates on each item in the tables variable below
+        # retrieveTable below is run on each item in the tables variable
 		### DAA - ADD CURRENT DATE TO FILENAMES
 		# from datetime import date
 		# today = str(date.today())
-		for count, (filename, table) in enumerate(tables.items()):
+		# the FIRST key in tables must be WQX_Stations, the other tables read the datum of each station from its file
+		WQXfile = os.path.join(saveLocation, '%s%s' % (list(tables)[0] + "_" + today, extension))
+		# retrieveTable writes the files for one item in the tables variable, count is the position of the item in
+		# tables (0 is WQX_Stations) and cursor is a cursor of the DataMart connection to use
+		# The files written and the sites found for the table are returned (as tableFiles and tableSites) instead of
+		# being added to writtenFiles and AllSites, because tables can be retrieved at the same time (see below)
+		def retrieveTable(count, filename, table, cursor):
+			tableFiles = {}
+			tableSites = {}
 			# creates and addes the full path of the file to be created for the full datasets as
-			# well as the date divided subsets. the filename_xx variables are used as part of the
-			# file writing process
-			writtenFiles[filename] = os.path.join(saveLocation, '%s%s' % (filename + "_" + today, extension))
-			filename_1 = os.path.join(saveLocation, '%s%s' % (filename + range_1 + "_" + today, extension))
-			filename_2 = os.path.join(saveLocation, '%s%s' % (filename + range_2 + "_" + today, extension))
-			filename_3 = os.path.join(saveLocation, '%s%s' % (filename + range_3 + "_" + today, extension))
-			filename_4 = os.path.join(saveLocation, '%s%s' % (filename + range_4 + "_" + today, extension))
-			filename_5 = os.path.join(saveLocation, '%s%s' % (filename + range_5 + "_" + today, extension))
-			filename_6 = os.path.join(saveLocation, '%s%s' % (filename + range_6 + "_" + today, extension))
-			filename_7 = os.path.join(saveLocation, '%s%s' % (filename + range_7 + "_" + today, extension))
-			filename_8 = os.path.join(saveLocation, '%s%s' % (filename + range_8 + "_" + today, extension))
-			filename_9 = os.path.join(saveLocation, '%s%s' % (filename + range_9 + "_" + today, extension))
-			filename_10 = os.path.join(saveLocation, '%s%s' % (filename + range_10 + "_" + today, extension))
-			filename_11 = os.path.join(saveLocation, '%s%s' % (filename + range_11 + "_" + today, extension))
-			filename_12 = os.path.join(saveLocation, '%s%s' % (filename + range_12 + "_" + today, extension))
-
-			writtenFiles[filename + range_1] = filename_1
-			writtenFiles[filename + range_2] = filename_2
-			writtenFiles[filename + range_3] = filename_3
-			writtenFiles[filename + range_4] = filename_4
-			writtenFiles[filename + range_5] = filename_5
-			writtenFiles[filename + range_6] = filename_6
-			writtenFiles[filename + range_7] = filename_7
-			writtenFiles[filename + range_8] = filename_8
-			writtenFiles[filename + range_9] = filename_9
-			writtenFiles[filename + range_10] = filename_10
-			writtenFiles[filename + range_11] = filename_11
-			writtenFiles[filename + range_12] = filename_12
+			# well as the date divided subsets. the yearly files are added by the YearPartitionRouter
+			# as they are written
+			tableFiles[filename] = os.path.join(saveLocation, '%s%s' % (filename + "_" + today, extension))
 
 			
-			# Since the WQX file has to be first, we use count == 0 as a way to filter these actions
-			# for the first iteration only. we want to grab the file path for the WQX file
-			if count == 0:
-				WQXfile = writtenFiles[filename]
 			##############################################################################
 			########################## SQL Statement  ####################################
 			##############################################################################
@@ -405,426 +617,187 @@ def python_get_data_2023_present(saveLocation, tables, SERVER1, UID, PWD, today)
 			if count == count:  ### Change back to  1 == 1:
 				# this is where we create a reader for each file in the "tables" variable
 				# using the filename iterable filename_0
-				with open(writtenFiles[filename], 'w', newline='', encoding='utf8') as csvfile:
+				with open(tableFiles[filename], 'w', newline='', encoding='utf8') as csvfile:
 					# we open a file and write the first row with the DictWriter tool
 					dw = csv.DictWriter(csvfile, fieldnames=columns, delimiter=sep, lineterminator='\n')
 					dw.writeheader()
 					# we create a writer object which we will only call towards the very end of the data
 					# quality estimation
 					writer = csv.writer(csvfile, csv.QUOTE_MINIMAL, delimiter=sep, lineterminator='\n')
-					# here we create and open three additional files where we will write rows if the meet
-					# our logical criteria. Notice that the all have the columns variable and the dates
-					# refer to the general time division we are using. Prior to 1999, 2000-2009, 2010-present
-					# 1
-					with open(filename_1, 'w', newline='', encoding='utf8') as csv1:
-						dw1 = csv.DictWriter(csv1, fieldnames=columns, delimiter=sep, lineterminator='\n')
-						dw1.writeheader()
-						writer1 = csv.writer(csv1, csv.QUOTE_MINIMAL, delimiter=sep, lineterminator='\n')
-						# 2
-						with open(filename_2, 'w', newline='', encoding='utf8') as csv2:
-							dw2 = csv.DictWriter(csv2, fieldnames=columns, delimiter=sep, lineterminator='\n')
-							dw2.writeheader()
-							writer2 = csv.writer(csv2, csv.QUOTE_MINIMAL, delimiter=sep, lineterminator='\n')
-							# 3
-							with open(filename_3, 'w', newline='', encoding='utf8') as csv3:
-								dw3 = csv.DictWriter(csv3, fieldnames=columns, delimiter=sep,
-														lineterminator='\n')
-								dw3.writeheader()
-								writer3 = csv.writer(csv3, csv.QUOTE_MINIMAL, delimiter=sep,
-														lineterminator='\n')
-								# 4
-								with open(filename_4, 'w', newline='', encoding='utf8') as csv4:
-									dw4 = csv.DictWriter(csv4, fieldnames=columns, delimiter=sep,
-															lineterminator='\n')
-									dw4.writeheader()
-									writer4 = csv.writer(csv4, csv.QUOTE_MINIMAL, delimiter=sep,
-															lineterminator='\n')
-									# 5
-									with open(filename_5, 'w', newline='', encoding='utf8') as csv5:
-										dw5 = csv.DictWriter(csv5, fieldnames=columns, delimiter=sep,
-																lineterminator='\n')
-										dw5.writeheader()
-										writer5 = csv.writer(csv5, csv.QUOTE_MINIMAL, delimiter=sep,
-																lineterminator='\n')
-										# 6
-										with open(filename_6, 'w', newline='', encoding='utf8') as csv6:
-											dw6 = csv.DictWriter(csv6, fieldnames=columns, delimiter=sep,
-																	lineterminator='\n')
-											dw6.writeheader()
-											writer6 = csv.writer(csv6, csv.QUOTE_MINIMAL, delimiter=sep,
-																	lineterminator='\n')
-											# 7
-											with open(filename_7, 'w', newline='', encoding='utf8') as csv7:
-												dw7 = csv.DictWriter(csv7, fieldnames=columns, delimiter=sep,
-																		lineterminator='\n')
-												dw7.writeheader()
-												writer7 = csv.writer(csv7, csv.QUOTE_MINIMAL, delimiter=sep,
-																		lineterminator='\n')
-												# 8
-												with open(filename_8, 'w', newline='', encoding='utf8') as csv8:
-													dw8 = csv.DictWriter(csv8, fieldnames=columns, delimiter=sep,
-																			lineterminator='\n')
-													dw8.writeheader()
-													writer8 = csv.writer(csv8, csv.QUOTE_MINIMAL, delimiter=sep,
-																			lineterminator='\n')
-													# 9
-													with open(filename_9, 'w', newline='', encoding='utf8') as csv9:
-														dw9 = csv.DictWriter(csv9, fieldnames=columns, delimiter=sep,
-																				lineterminator='\n')
-														dw9.writeheader()
-														writer9 = csv.writer(csv9, csv.QUOTE_MINIMAL, delimiter=sep,
-																				lineterminator='\n')
-														# 10
-														with open(filename_10, 'w', newline='', encoding='utf8') as csv10:
-															dw10 = csv.DictWriter(csv10, fieldnames=columns, delimiter=sep,
-																					lineterminator='\n')
-															dw10.writeheader()
-															writer10 = csv.writer(csv10, csv.QUOTE_MINIMAL, delimiter=sep,
-																					lineterminator='\n')
-															# 11
-															with open(filename_11, 'w', newline='', encoding='utf8') as csv11:
-																dw11 = csv.DictWriter(csv11, fieldnames=columns, delimiter=sep,
-																						lineterminator='\n')
-																dw11.writeheader()
-																writer11 = csv.writer(csv11, csv.QUOTE_MINIMAL, delimiter=sep,
-																						lineterminator='\n')
-																# 12
-																with open(filename_12, 'w', newline='', encoding='utf8') as csv12:
-																	dw12 = csv.DictWriter(csv12, fieldnames=columns, delimiter=sep,
-																							lineterminator='\n')
-																	dw12.writeheader()
-																	writer12 = csv.writer(csv12, csv.QUOTE_MINIMAL, delimiter=sep,
-																							lineterminator='\n')
-																	#########################
-																	# if the table is the WQX stations table
-																	if table == 'DM_WQX_Stations_MV':
-																		for row in cursor:
-																			# we have to make a distinction between None, 'None', and ''
-																			# 'None' and '' are used specifically in the datasets, but
-																			# None gets translated to 'None' unless we replace it with
-																			# '' explicitly
-																			row = [str(word) if word is not None else '' for word in row]
-																			# strip all other invalid characters using decodeAndStrip definition
-																			filtered = [decodeAndStrip(t) for t in list(row)]
-																			# join the column list and the new filtered list
-																			# to make a dictionary that we can use througout this script
-																			recordDict = dict(zip(columns, filtered))
-																			# Sometime the Longitude gets entered as 119 instead of -119...
-																			# make sure Longitude value is negative and less than 10000 (could be projected)
-																			try:
-																				long = float(recordDict[Longitude])
-																				if 0. < long < 10000.0 :
-																					recordDict[Longitude] = -long
-																			except ValueError:
-																				pass
-																			# write the values of our recordDictionary to the WQX file
-																			writer.writerow(list(recordDict.values()))
-																	else:
-																		# if not WQX filename
-																		# create a dictionary of code values specific to the filenames needs
-																		# see Dictionary Fixer above
-																		Mod_CodeColumns = DictionaryFixer(CodeColumns, filename)
-																		for row in cursor:
-																			# see None, 'None' and '' above
-																			filtered = [decodeAndStrip(t) if t is not None else '' for t in list(row)]
-																			# we have to make columns and filtered the same length otherwise python
-																			# just uses the shorter of the two. since we want to add a column for
-																			# datum, data quality and estimator, but sometimes only 2, we use the while
-																			# function to iterate
-																			while len(columns) > len(filtered):
-																				filtered += ['']
-																			# create a dictionary of columns and our current file row!!
-																			recordDict = dict(zip(columns, filtered))
-																			# make sure Longitude value is negative and less than 10000 (could be projected)
-																			try:
-																				long = float(recordDict[Longitude])
-																				if 0. < long < 10000.0 :
-																					recordDict[Longitude] = -long
-																			except ValueError:
-																				pass
-																			#####  Benthic datasets do not need datum added  #####
-																			if filename == 'BenthicData':
-																				pass
-																			# Everyone else ...
-																			# check to see if the current record's station code is in the variable
-																			# WQX_Sites and if it is, then store that datum value to our current record
-																			# otherwise store 'NR' not recorded
-																			else:
-																				if recordDict['StationCode'] in WQX_Sites:
-																					recordDict['Datum'] = WQX_Sites[recordDict['StationCode']]
-																				else:
-																					recordDict['Datum'] = 'NR'
-																			#####  ^^^^^^^^^^^^^^^^^^^^^  #####
-																			DQ = []
-																			############
-																			# This is the begining of the data quality estimation
-																			# for each list in the modified dictionary of QA codes
-																			for codeCol in list(Mod_CodeColumns):
-																				# if the list is QACode
-																				if codeCol == 'QACode':
-																					# for each value in the specific record
-																					# split the value up by commas and return a list
-																					# ie.  codeVal may be 'QAC,DNR,LOB' which is a string
-																					# this would return ['QAC', 'DNR', 'LOB'] which is an iterable list
-																					for codeVal in recordDict[codeCol].split(','):
-																						# if QAC or DNR or LOB is in the QACode list
-																						if codeVal in list(Mod_CodeColumns[codeCol]):
-																							# add that numerical value to a temporary variable called "DQ"
-																							DQ += [Mod_CodeColumns[codeCol][codeVal]]
-																						# For this example record, QAC DNR and LOB would each add a
-																						# numerical value to DQ. DQ might be [2, 3, 1]
-																						# we continue to use DQ to collect all of the numberical values as we
-																						#  iterate through all of the lists in Mod_CodeColumns
-																				if codeCol == 'StationCode':
-																					# if a record has 000NONPJ or any variants in the StationCode value,
-																					# than add 0 to DQ.
-																					# elif any values are in the StationCode list, add those values to DQ.
-																					if bool(re.search('000NONPJ', recordDict[codeCol])):
-																						DQ += [0]
-																					elif codeVal in list(Mod_CodeColumns[codeCol]):
-																						DQ += [Mod_CodeColumns[codeCol][codeVal]]
-																				elif codeCol == 'Analyte' or codeCol == 'AnalyteName':
-																					# search for surrogate and mark DQ with a 0
-																					if bool(re.search('[Ss]urrogate', recordDict[codeCol])):
-																						DQ += [0]
-																				elif codeCol == 'ResultQualCode' or codeCol == 'ResQualCode':
-																					for codeVal in [recordDict[codeCol]]:
-																						# Special Rules
-																						# for both IR2018_WQ and IR2018_Tissue, if the ResultQualCode has a
-																						# DNQ, then we have to make sure the year is less than 2008 but
-																						# dates for these datasets were reported as monthdayyear, so we need
-																						# the last 4. If the year is less than 2008, we mark DQ with a reject
-																						# number. If it is greater than 2008, we mark it with a pass value
-																						if table == 'IR2018_WQ' or table == 'IR2018_Tissue' and codeVal == 'DNQ':
-																							yearTest = int(recordDict['SampleDate'][-4:])
-																							if isinstance(yearTest, int) and yearTest < 2008:
-																								DQ += [6]
-																								#add rule identifier so that we seen the quality indicator reflect this rule
-																						elif codeVal == 'DNQ' and int(recordDict['SampleDate'][:4]) < 2008:
-																							#### add rule identifier so that we seen the quality indicator reflect this rule
-																							DQ += [6]
-																						elif codeVal == 'ND':
-																							# the Benthic dataset can have an ND value as long as the result
-																							# is not positive. Record is a pass if less than or equal to zero
-																							# reject if result is positive
-																							try:
-																								RQC = recordDict['Result']
-																								if not isinstance(RQC, str) and RQC > 0:
-																									DQ += [6]
-																								else:
-																									DQ += [1]
-																							except KeyError:
-																								DQ += [1]
-																						elif codeVal in list(Mod_CodeColumns[codeCol]):
-																							# End of Special Rules for ResultQualCode
-																							# check each value an add numerical key to DQ
-																							DQ += [Mod_CodeColumns[codeCol][codeVal]]
-																				elif codeCol == 'Result':
-																					# for the Result we just need to make sure that results can be empty if
-																					# ND is the ResultQualCode or ResQualCode
-																					# yes they have different names and yes I should have made a more generic
-																					#  search for these terms.
-																					#
-																					for codeVal in recordDict[codeCol]:
-																						if codeVal == '':
-																							if 'ResultQualCode' in recordDict.keys():
-																								if 'ND' == recordDict['ResultQualCode']:
-																									DQ += [1]
-																							if 'ResQualCode' in recordDict.keys():
-																								if 'ND' == recordDict['ResQualCode']:
-																									DQ += [1]
-																						else:
-																							if codeVal in list(Mod_CodeColumns[codeCol]):
-																								DQ += [Mod_CodeColumns[codeCol][codeVal]]
-																				else:
-																					# for all other non Special Rules, check each values in the record column
-																					#  to see if its in the dictionary of QA codes. if it is in the
-																					# apropriate list, then add the numerical code to DQ
-																					for codeVal in [recordDict[codeCol]]:
-																						if codeVal in list(Mod_CodeColumns[codeCol]):
-																							DQ += [Mod_CodeColumns[codeCol][codeVal]]
-																			try:
-																				# we get the max value of DQ
-																				MaxDQ = max(DQ)
-																			except ValueError:
-																				# if DQ doesn't have any values, it means that it slipped through the cracks
-																				# and is some kind of an error. Check it out
-																				MaxDQ = 7
-																				DQ += [MaxDQ, ]
-																			## This marks the beginning of the Quality indicator column value generator
-																			QInd = []
-																			# now that we have DQ with all of the numerical codes that can up for that record...
-																			for codeCol in list(Mod_CodeColumns.keys()):
-																				# make sure codeValList is empty
-																				codeValList = []
-																				ValuesEqMaxDQ = []
-																				# get the record specific values from each QA list and store
-																				# them to codeValList
-																				if codeCol == 'QACode':
-																					codeValList = recordDict[codeCol].split(',')
-																				else:
-																					codeValList = [recordDict[codeCol], ]
-																				# for each code in our new list for this particular record, we check to see
-																				# if the corresponding numerical code value is equal to the max value of DQ.
-																				# If it is we save the particular code to ValuesEqMaxDQ. IfValuesEqMaxDQ
-																				# isn't empty, we save the QA code list name with the offending values to "QInd"
-																				for codeVal in codeValList:
-																					# This part is tricky.
-																					if codeVal in Mod_CodeColumns[codeCol] and MaxDQ == int(Mod_CodeColumns[codeCol][codeVal]):
-																						ValuesEqMaxDQ += [codeVal, ]
-																				if not ValuesEqMaxDQ == []:
-																					QInd += [codeCol + ':' + ','.join(str(instance) for instance in ValuesEqMaxDQ)]
-																			# A word about that DQ variable.
-																			# DQ might host a long list of numbers but if there is ever a zero, that whole
-																			# record should be classified as a QC record. If there isnt a zero and the
-																			# maximum value is a 1, then that record passed our data quality estimate
-																			# unblemished. If there isn't a zero and the max DQ values is greater than 1,
-																			# then ... we get the max value and store the corresponding value (from the
-																			# DQ_Codes dictionary, defined above). If the Max DQ is 6 (which is a reject
-																			# record) and QInd is empty, then this is a special rule case and we label it as
-																			# such. Otherwise, we throw all of the QInd information into the Quality
-																			# indicator column. QInd might look like:
-																			#   ['ResQualCode:npr,kqed', 'BatchVerificationCode:lol,btw,omg', ]
-																			# and the this gets converted and stored into the records new column called Data
-																			# Quality indicator a:
-																			# 'ResQualCode:npr,kqed; BatchVerificationCode:lol,btw,omg'
-																			if min(DQ) == 0:
-																				recordDict['DataQuality'] = DQ_Codes[0]
-																			elif max(DQ) == 1:
-																				recordDict['DataQuality'] = DQ_Codes[1]
-																			else:
-																				recordDict['DataQuality'] = DQ_Codes[MaxDQ]
-																				if MaxDQ == 6 and QInd == []:
-																					recordDict['DataQualityIndicator'] = 'ResultQualCode Special Rules'
-																				else:
-																					recordDict['DataQualityIndicator'] = '; '.join(str(ColVal) for ColVal in QInd)
-																			#########################################################
-																			#########################################################
-	#																		# DA - adding to check numeric columns for numeric values
-																			if filename == 'WaterChemistryData':
-																				for field in ["CollectionDepth", "CollectionReplicate", "ResultsReplicate", "Result", "MDL", "RL", "Latitude", "Longitude", "DilutionFactor", "ExpectedValue", "DistanceFromBank", "StreamWidth", "StationWaterDepth"]:
-																					try:
-																						converted_numb = str(float(recordDict[field]))
-																						recordDict[field] = converted_numb
-																					except ValueError: 
-																						converted_numb = "NaN"
-																						recordDict[field] = converted_numb
-																			if filename == 'BenthicData':
-																				for field in ["Latitude", "Longitude", "CollectionReplicate", "DistinctOrganism", "Counts", "CollectionDepth", "GrabSize", "PercentSampleCounted", "TotalGrids", "GridsAnalyzed", "GridsVolumeAnalyzed", "TargetOrganismCount", "ActualOrganismCount", "ExtraOrganismCount", "QCOrganismCount", "DiscardedOrganismCount"]:
-																					try:
-																						converted_numb = str(float(recordDict[field]))
-																						recordDict[field] = converted_numb
-																					except ValueError: 
-																						converted_numb = "NaN"
-																						recordDict[field] = converted_numb
-																			if filename == 'ToxicityData':
-																				for field in ["CollectionDepth", "CollectionReplicate", "LabReplicate", "Result", "Latitude", "Longitude", "Dilution", "TreatmentConcentration", "DistanceFromBank", "StreamWidth", "StationWaterDepth", "PctControl", "RepCount", "Mean", "StdDev", "Alphalevel", "EvalThreshold", "MSD", "CalculatedValue", "PercentEffect"]:
-																					try:
-																						converted_numb = str(float(recordDict[field]))
-																						recordDict[field] = converted_numb
-																					except ValueError: 
-																						converted_numb = "NaN"
-																						recordDict[field] = converted_numb
-																			if filename == 'TissueData':
-																				for field in ["Latitude", "Longitude", "NumberFishperComp", "CompositeReplicate", "ResultReplicate", "Result", "MDL", "RL", "DilutionFactor", "WeightAvg(g)", "TLMax(mm)", "TLAvgLength(mm)","CompSizeCheck", "SampleDateRange(Days)", "CollectionReplicate", "TotalCount", "ForkLength", "TotalLength", "OrganismWeight", "TissueWeight", "CompositeWeight", "TLMin(mm)"]:
-																					try:
-																						converted_numb = str(float(recordDict[field]))
-																						recordDict[field] = converted_numb
-																					except ValueError: 
-																						converted_numb = "NaN"
-																						recordDict[field] = converted_numb
-																			if filename == 'HabitatData':
-																				for field in ["CollectionReplicate", "Latitude", "Longitude", "DistanceFromBank", "StreamWidth", "StationWaterDepth"]:
-																					try:
-																						converted_numb = str(float(recordDict[field]))
-																						recordDict[field] = converted_numb
-																					except ValueError: 
-																						converted_numb = "NaN"
-																						recordDict[field] = converted_numb
-																			#########################################################
-																			#########################################################
-																			# Now that we have something very special called
-																			#
-																			###############	  recordDict	 ##############
-																			#
-																			# we write its values to each of our open files... millions of times.
-																			recordYear = int(recordDict['SampleDate'][:4])
-																			if recordYear == years[0]:
-																				writer1.writerow(list(recordDict.values()))
-																			elif recordYear == years[1]:
-																				writer2.writerow(list(recordDict.values()))
-																			elif recordYear == years[2]:
-																				writer3.writerow(list(recordDict.values()))
-																			elif recordYear == years[3]:
-																				writer4.writerow(list(recordDict.values()))
-																			elif recordYear == years[4]:
-																				writer5.writerow(list(recordDict.values()))
-																			elif recordYear == years[5]:
-																				writer6.writerow(list(recordDict.values()))
-																			elif recordYear == years[6]:
-																				writer7.writerow(list(recordDict.values()))
-																			elif recordYear == years[7]:
-																				writer8.writerow(list(recordDict.values()))
-																			elif recordYear == years[8]:
-																				writer9.writerow(list(recordDict.values()))
-																			elif recordYear == years[9]:
-																				writer10.writerow(list(recordDict.values()))
-																			elif recordYear == years[10]:
-																				writer11.writerow(list(recordDict.values()))
-																			elif recordYear == years[11]:
-																				writer12.writerow(list(recordDict.values()))
-																			# all years
-																			# writer.writerow(list(recordDict.values()))
-																			# for each line that we process, all of the sites found in benthic, water chem,
-																			# tissue, habitat, WQX, Toxicity we store the Stationname, Lat/Long and datum to
-																			# this temporary thing called:
-																			#							  AllSites
-																			if recordDict['StationCode'] not in AllSites:
-																				AllSites[recordDict['StationCode']] = [recordDict['StationName'],
-																													   recordDict[Latitude], recordDict[Longitude],
-																													   recordDict['Datum'], ]
-					# these lines remove files that do not have anything but headers
-					# Sometimes we create empty files to hold data but nothing ends up
-					# going into them. So we erase them based on # of bytes which is 2000
-					# if os.stat(writtenFiles[filename]).st_size < 2000:
-						# os.remove(writtenFiles[filename])
-					if os.stat(filename_1).st_size < 2000:
-						os.remove(filename_1)
-						writtenFiles.pop(filename + range_1)
-					if os.stat(filename_2).st_size < 2000:
-						os.remove(filename_2)
-						writtenFiles.pop(filename + range_2)
-					if os.stat(filename_3).st_size < 2000:
-						os.remove(filename_3)
-						writtenFiles.pop(filename + range_3)
-					if os.stat(filename_4).st_size < 2000:
-						os.remove(filename_4)
-						writtenFiles.pop(filename + range_4)
-					if os.stat(filename_5).st_size < 2000:
-						os.remove(filename_5)
-						writtenFiles.pop(filename + range_5)
-					if os.stat(filename_6).st_size < 2000:
-						os.remove(filename_6)
-						writtenFiles.pop(filename + range_6)
-					if os.stat(filename_7).st_size < 2000:
-						os.remove(filename_7)
-						writtenFiles.pop(filename + range_7)
-					if os.stat(filename_8).st_size < 2000:
-						os.remove(filename_8)
-						writtenFiles.pop(filename + range_8)
-					if os.stat(filename_9).st_size < 2000:
-						os.remove(filename_9)
-						writtenFiles.pop(filename + range_9)
-					if os.stat(filename_10).st_size < 2000:
-						os.remove(filename_10)
-						writtenFiles.pop(filename + range_10)
-					if os.stat(filename_11).st_size < 2000:
-						os.remove(filename_11)
-						writtenFiles.pop(filename + range_11)
-					if os.stat(filename_12).st_size < 2000:
-						os.remove(filename_12)
-						writtenFiles.pop(filename + range_12)
+					# here we create the router for the yearly files. Each yearly file is opened, with the
+					# columns variable as its header, when the first record from its year is written
+					with YearPartitionRouter(filename, columns, yearPartition, tableFiles, saveLocation, sep, extension) as router:
+						#########################
+						# if the table is the WQX stations table
+						if table == 'DM_WQX_Stations_MV':
+							for rows in fetchBlocks(cursor):
+								# we have to make a distinction between None, 'None', and ''
+								# 'None' and '' are used specifically in the datasets, but
+								# None gets translated to 'None' unless we replace it with
+								# '' explicitly, and strip all other invalid characters using decodeAndStrip definition, for
+								# the whole block at once
+								filteredBlock = [[decodeAndStrip(word) if word is not None else '' for word in row] for row in rows]
+								blockValues = []
+								for filtered in filteredBlock:
+									# join the column list and the new filtered list
+									# to make a dictionary that we can use througout this script
+									recordDict = dict(zip(columns, filtered))
+									# Sometime the Longitude gets entered as 119 instead of -119...
+									# make sure Longitude value is negative and less than 10000 (could be projected)
+									try:
+										long = float(recordDict[Longitude])
+										if 0. < long < 10000.0 :
+											recordDict[Longitude] = -long
+									except ValueError:
+										pass
+									# add the values of our recordDictionary to the block
+									blockValues.append(list(recordDict.values()))
+								# write the values of the block's records to the WQX file
+								writer.writerows(blockValues)
+						else:
+							# if not WQX filename
+							# create a dictionary of code values specific to the filenames needs
+							# see Dictionary Fixer above
+							Mod_CodeColumns = DictionaryFixer(CodeColumns, filename)
+							# and compile its data quality rules, see compileDataQuality above
+							qualityRules = compileDataQuality(Mod_CodeColumns, table)
+							for rows in fetchBlocks(cursor):
+								# see None, 'None' and '' above. The whole block is stripped at once
+								filteredBlock = [[decodeAndStrip(t) if t is not None else '' for t in row] for row in rows]
+								# the sample year and values of each record in the block, written to the files once the block
+								# is processed
+								blockRecords = []
+								for filtered in filteredBlock:
+									# we have to make columns and filtered the same length otherwise python
+									# just uses the shorter of the two. since we want to add a column for
+									# datum, data quality and estimator, but sometimes only 2, we use the while
+									# function to iterate
+									while len(columns) > len(filtered):
+										filtered += ['']
+									# create a dictionary of columns and our current file row!!
+									recordDict = dict(zip(columns, filtered))
+									# make sure Longitude value is negative and less than 10000 (could be projected)
+									try:
+										long = float(recordDict[Longitude])
+										if 0. < long < 10000.0 :
+											recordDict[Longitude] = -long
+									except ValueError:
+										pass
+									#####  Benthic datasets do not need datum added  #####
+									if filename == 'BenthicData':
+										pass
+									# Everyone else ...
+									# check to see if the current record's station code is in the variable
+									# WQX_Sites and if it is, then store that datum value to our current record
+									# otherwise store 'NR' not recorded
+									else:
+										if recordDict['StationCode'] in WQX_Sites:
+											recordDict['Datum'] = WQX_Sites[recordDict['StationCode']]
+										else:
+											recordDict['Datum'] = 'NR'
+									#####  ^^^^^^^^^^^^^^^^^^^^^  #####
+									# This is the data quality estimation, see scoreDataQuality above
+									scoreDataQuality(recordDict, qualityRules)
+									#########################################################
+									#########################################################
+									# DA - adding to check numeric columns for numeric values
+									if filename == 'WaterChemistryData':
+										for field in ["CollectionDepth", "CollectionReplicate", "ResultsReplicate", "Result", "MDL", "RL", "Latitude", "Longitude", "DilutionFactor", "ExpectedValue", "DistanceFromBank", "StreamWidth", "StationWaterDepth"]:
+											try:
+												converted_numb = str(float(recordDict[field]))
+												recordDict[field] = converted_numb
+											except ValueError: 
+												converted_numb = "NaN"
+												recordDict[field] = converted_numb
+									if filename == 'BenthicData':
+										for field in ["Latitude", "Longitude", "CollectionReplicate", "DistinctOrganism", "Counts", "CollectionDepth", "GrabSize", "PercentSampleCounted", "TotalGrids", "GridsAnalyzed", "GridsVolumeAnalyzed", "TargetOrganismCount", "ActualOrganismCount", "ExtraOrganismCount", "QCOrganismCount", "DiscardedOrganismCount"]:
+											try:
+												converted_numb = str(float(recordDict[field]))
+												recordDict[field] = converted_numb
+											except ValueError: 
+												converted_numb = "NaN"
+												recordDict[field] = converted_numb
+									if filename == 'ToxicityData':
+										for field in ["CollectionDepth", "CollectionReplicate", "LabReplicate", "Result", "Latitude", "Longitude", "Dilution", "TreatmentConcentration", "DistanceFromBank", "StreamWidth", "StationWaterDepth", "PctControl", "RepCount", "Mean", "StdDev", "Alphalevel", "EvalThreshold", "MSD", "CalculatedValue", "PercentEffect"]:
+											try:
+												converted_numb = str(float(recordDict[field]))
+												recordDict[field] = converted_numb
+											except ValueError: 
+												converted_numb = "NaN"
+												recordDict[field] = converted_numb
+									if filename == 'TissueData':
+										for field in ["Latitude", "Longitude", "NumberFishperComp", "CompositeReplicate", "ResultReplicate", "Result", "MDL", "RL", "DilutionFactor", "WeightAvg(g)", "TLMax(mm)", "TLAvgLength(mm)","CompSizeCheck", "SampleDateRange(Days)", "CollectionReplicate", "TotalCount", "ForkLength", "TotalLength", "OrganismWeight", "TissueWeight", "CompositeWeight", "TLMin(mm)"]:
+											try:
+												converted_numb = str(float(recordDict[field]))
+												recordDict[field] = converted_numb
+											except ValueError: 
+												converted_numb = "NaN"
+												recordDict[field] = converted_numb
+									if filename == 'HabitatData':
+										for field in ["CollectionReplicate", "Latitude", "Longitude", "DistanceFromBank", "StreamWidth", "StationWaterDepth"]:
+											try:
+												converted_numb = str(float(recordDict[field]))
+												recordDict[field] = converted_numb
+											except ValueError: 
+												converted_numb = "NaN"
+												recordDict[field] = converted_numb
+									#########################################################
+									#########################################################
+									# Now that we have something very special called
+									#
+									###############	  recordDict	 ##############
+									#
+									# we add its values to the block, which is written to each of our open files... millions of times.
+									recordYear = int(recordDict['SampleDate'][:4])
+									blockRecords.append((recordYear, list(recordDict.values())))
+									# for each line that we process, all of the sites found in benthic, water chem,
+									# tissue, habitat, WQX, Toxicity we store the Stationname, Lat/Long and datum to
+									# this temporary thing called:
+									#							  AllSites
+									if recordDict['StationCode'] not in tableSites:
+										tableSites[recordDict['StationCode']] = [recordDict['StationName'],
+																				 recordDict[Latitude], recordDict[Longitude],
+																				 recordDict['Datum'], ]
+								# the block's records go to the yearly files (see YearPartitionRouter above)
+								router.writerows(blockRecords)
+								# all years
+								# writer.writerows([values for recordYear, values in blockRecords])
 					print("Finished data retrieval for the %s table" % filename)
+			return tableFiles, tableSites
+
+		# retrieveTableOnNewConnection runs retrieveTable over a connection of its own
+		def retrieveTableOnNewConnection(count, filename, table):
+			tableCnxn = connectDataMart()
+			try:
+				return retrieveTable(count, filename, table, tableCnxn.cursor())
+			finally:
+				tableCnxn.close()
+
+		# WQX_Stations is retrieved first. The other tables do not depend on each other, so when max_table_workers is
+		# more than 1 they are retrieved at the same time by that many threads, each with its own connection (pyodbc
+		# lets the other threads run while it waits on the server). max_table_workers also limits the number of
+		# queries sent to the DataMart at the same time, so keep it low. It only has an effect when tables has more
+		# than one table besides WQX_Stations (1_ceden_automate.R only does that in single-scan mode).
+		tableItems = list(tables.items())
+		tableResults = [retrieveTable(0, tableItems[0][0], tableItems[0][1], cursor)]
+		if max_table_workers > 1 and len(tableItems) > 2:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=max_table_workers) as executor:
+				futures = [executor.submit(retrieveTableOnNewConnection, count, filename, table)
+						   for count, (filename, table) in enumerate(tableItems) if count > 0]
+				# result() raises the error of a table that failed
+				tableResults += [future.result() for future in futures]
+		else:
+			for count, (filename, table) in enumerate(tableItems):
+				if count > 0:
+					tableResults.append(retrieveTable(count, filename, table, cursor))
+		# the files and sites of the tables are merged in the order of tables, so (as when the tables are retrieved
+		# one after another) each station in AllSites gets the name, lat/long and datum from the first table it is
+		# in, whatever order the threads finished in
+		for tableFiles, tableSites in tableResults:
+			writtenFiles.update(tableFiles)
+			for stationCode, site in tableSites.items():
+				if stationCode not in AllSites:
+					AllSites[stationCode] = site
 		return writtenFiles, AllSites
 
 
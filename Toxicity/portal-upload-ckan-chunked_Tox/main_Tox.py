@@ -1,9 +1,13 @@
-import click
-import json
-import math
 import os
-import requests
-from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+import sys
+
+# The uploader is shared by the upload scripts of all the datasets, in
+# ckan-python-chunked-file-upload-example/ckan_chunked_upload.py (the R scripts that source this file pass
+# its folder in the ckan_chunked_upload_path environment variable)
+sys.path.insert(0, os.environ.get('ckan_chunked_upload_path') or
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                             'ckan-python-chunked-file-upload-example'))
+from ckan_chunked_upload import *
 
 from datetime import date #, timedelta
 today = str(date.today())
@@ -23,117 +27,9 @@ uploads = {f"Toxicity-Replicate-Records_{today}.csv": "6fd7b8d7-f8dd-454f-98bb-0
 
 chunk_size = 1024 * 1024 * 64 # 64MB
 
-
-# Post request to CKAN action API
-def ckanRequest(action, data_dict):
-    encoder = MultipartEncoder(fields=data_dict)
-    callback = getCallback(encoder)
-    monitor = MultipartEncoderMonitor(encoder, callback)
-    try:
-        r = requests.post(
-                '{ckan_base}/api/action/{action}'.format(ckan_base=ckan_base, action=action),
-                data=monitor,
-                headers={
-                    'Content-Type' : monitor.content_type,
-                    'X-CKAN-API-Key': ckan_api_key
-                }
-            )
-        return r.json()
-    except:
-        print(r.text)
-        return
-
-
-def getCallback(encoder):
-    prog = click.progressbar(length=encoder.len, width=0)
-
-    def callback(monitor):
-        prog.pos = monitor.bytes_read
-        prog.update(0)
-
-    return callback
-
-
-# Read file in chunks
-def readInChunks(file_object, chunk_size=chunk_size):
-    while True:
-        data = file_object.read(chunk_size)
-        if not data:
-            break
-        yield data
-
-
-def ckanUploadFile(resource_id, file_path):
-    file_name = os.path.basename(file_path)
-    file_size = os.path.getsize(file_path)
-
-    chunk_count = math.ceil(float(file_size) / chunk_size)
-    part_number = 1
-
-    # Initiate multipart upload to get upload_id
-    init_dict = {
-        'id': resource_id,
-        'name': file_name,
-        'size': str(file_size)
-    }
-    init_response = ckanRequest('cloudstorage_initiate_multipart', init_dict)
-    if init_response.get('success'):
-        print('Ready to upload {0}\n{1} chunks\n'.format(file_name, chunk_count))
-    else:
-        print('Unable to initiate multipart upload')
-        return
-    upload_id = init_response.get('result', {}).get('id')
-
-    # Read file and upload in chunks
-    with open(file_path, 'rb') as upload_file:
-        for chunk in readInChunks(upload_file):
-            upload_dict = {
-                'id': resource_id,
-                'uploadId': upload_id,
-                'partNumber': str(part_number),
-                'upload': (file_name, chunk, 'text/plain')
-            }
-            print('Uploading chunk {}'.format(part_number))
-            upload_response = ckanRequest('cloudstorage_upload_multipart', upload_dict)
-            if upload_response.get('success'):
-                print('Chunk {} sent to server\n'.format(part_number))
-                part_number += 1
-            else:
-                print('Error uploading chunk {}'.format(part_number))
-                return
-
-    # Finish upload by converting separate uploaded parts into single file
-    finish_dict = {
-        'uploadId': upload_id,
-        'id': resource_id,
-        'save_action': 'go-metadata'
-    }
-    finish_response = ckanRequest('cloudstorage_finish_multipart', finish_dict)
-    if finish_response.get('success'):
-        print('All chunks sent to server')
-    else:
-        print('Error finalizing uploading chunk')
-        return
-
-    # Update resource
-    data_dict = {
-        'id': resource_id,
-        'multipart_name': file_name,
-        'url': file_name,
-        'size': str(file_size),
-        'url_type': 'upload'
-    }
-    res_update_response = ckanRequest('resource_patch', data_dict)
-    if res_update_response.get('success'):
-        print('Resource has been updated.')
-        print(res_update_response)
-    else:
-        print('Unable to finish multipart upload')
-        return
-
-    return
-
-
+# Pass the settings above to the uploader (other settings, e.g. max_workers or read_mode, are described in
+# the README and can be added here)
+configure(ckan_base=ckan_base, ckan_api_key=ckan_api_key, chunk_size=chunk_size)
 
 
 #### MAIN FUNCTION ###
@@ -145,17 +41,11 @@ def ckanUploadFile(resource_id, file_path):
 #    # File path of file to upload to CKAN
 #    # file_path = '/Users/jayguo/Documents/waterchemistrydata_prior_to_2000_2019-12-03.csv'
 #    file_path = 'C:/Users/daltare/Desktop/DELETE/WaterChemistryData_2000-2009_2020-01-15_2.csv'
-#    ckanUploadFile(resource_id, file_path)
+#    ckanUploadFile(resource_id, file_path, ckan_api_key)
 
 
 # Loop
 ### MAIN FUNCTION ###
 if __name__ == "__main__":
-    for file in uploads:
-        # Resource id of existing CKAN resource
-        resource_id = uploads[file]
-
-        # File path of file to upload to CKAN
-        # file_path = '/Users/jayguo/Documents/waterchemistrydata_prior_to_2000_2019-12-03.csv'
-        file_path = upload_files_location + file
-        ckanUploadFile(resource_id, file_path)
+    # Upload the files largest first, upload_slots files at a time
+    ckanUploadBatch(uploads, ckan_api_key, upload_files_location)
@@ -0,0 +1,1735 @@
+# Chunked (multipart) uploads of files to CKAN resources, shared by main.py and the upload scripts of each
+# dataset (main_CEDEN_function.py, main_eSMR.py, main_SMARTS.py, main_Tox*.py). The settings below are the
+# defaults; scripts change them with configure().
+import asyncio
+import click
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import queue
+import random
+import requests
+import sys
+import threading
+import time
+import zipfile
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+try:
+    import zstandard # optional - only needed for compression = 'zstd'
+except ImportError:
+    zstandard = None
+
+# Imported by the upload scripts (from ckan_chunked_upload import *)
+__all__ = [
+    'configure', 'ckanUploadFile', 'closeSession', 'ckanUploadFiles', 'ckanUploadBatch', 'getMetricsPath',
+    'ckanUploadIterable'
+]
+
+
+####### CKAN PARAMETERS #######
+ckan_base = 'https://data.ca.gov'
+ckan_api_key = os.environ.get('data_portal_key') # used by the functions below when no API key is passed to them
+
+####### UPLOAD SETTINGS #######
+chunk_size = 1024 * 1024 * 64 # 64MB
+adaptive_chunk_size = False # pick the chunk size for each file from its size and the measured upload speed (see pickChunkSize)
+min_chunk_size = 1024 * 1024 * 5 # 5MB - smallest part accepted by the cloud storage backend (except for the last part)
+max_chunk_size = 1024 * 1024 * 256 # 256MB - largest chunk picked by adaptive_chunk_size
+max_chunk_count = 10000 # maximum number of parts in one multipart upload
+request_overhead = 0.05 # with adaptive_chunk_size, size chunks so the per-request latency is at most ~5% of the time to send a chunk
+max_workers = 1 # maximum number of chunks uploaded at the same time (1 = upload chunks one at a time)
+resume_uploads = True # keep a journal next to each file so an interrupted upload continues where it left off
+read_mode = 'read' # how chunks are read from the file: 'read' (copy each chunk into memory), 'mmap' (memory-mapped file), 'stream' (stream each chunk from disk) or 'pread' (each upload thread reads its own chunk from its offset)
+read_ahead = 1 # number of chunks read from disk ahead of the upload in 'read' mode (0 = no read-ahead)
+max_files_in_flight = 4 # ckanUploadFiles: maximum number of files uploaded at the same time
+max_parts_in_flight = 8 # ckanUploadFiles: maximum number of chunks being sent at the same time, across all files
+max_bytes_in_flight = 1024 * 1024 * 512 # 512MB - ckanUploadFiles: maximum size of the chunks being sent at the same time, across all files
+upload_slots = 1 # ckanUploadBatch: number of files uploaded at the same time (largest files first)
+assumed_throughput = 1024 * 1024 * 5 # 5MB/s - upload speed used to predict upload times until it has been measured
+verify_chunks = False # compare the MD5 of each part (computed in a background thread, see FileChecksums) with the ETag returned by the server
+compute_file_hash = False # compute the file's SHA-256 in a background thread while it is uploaded and save it in the resource's hash_field
+compression = None # compress files while they are uploaded: None, 'gzip' (.csv.gz), 'zip' (.zip) or 'zstd' (.csv.zst, needs the zstandard package)
+compression_level = 6 # compression level for 'gzip' / 'zip' (1 = fastest ... 9 = smallest)
+skip_unchanged = False # skip files whose size and hash match the resource's current file (see isResourceUnchanged)
+hash_field = 'hash' # resource field that holds the hash of the uploaded file
+progress_mode = 'bar' # 'bar' (one progress line for everything being uploaded) or 'silent' (no progress or per-chunk output, e.g. for scheduled runs)
+progress_interval = 0.5 # seconds between updates of the progress line (30 seconds when output is not a terminal, e.g. a log file)
+metrics_location = None # folder to write upload metrics to (one JSON-lines file per run, upload-metrics_<date>_<time>.jsonl), or None to not record metrics
+pool_size = 10 # maximum number of keep-alive connections to the CKAN site shared by all requests
+bandwidth_limit = None # maximum upload speed in MB/s, shared by all parts and files being uploaded, or None for no limit
+# Time-of-day changes to bandwidth_limit: list of ('HH:MM' start, 'HH:MM' end, MB/s or None for no limit)
+# periods in local time (periods can cross midnight), e.g. [('07:00', '18:00', 2), ('18:00', '07:00', None)]
+# to limit uploads to 2MB/s during office hours only. bandwidth_limit applies outside the listed periods.
+bandwidth_schedule = []
+request_timeout = (60, 900) # seconds to wait for the connection / for each response from the server
+
+# Retry settings for CKAN action API requests: total number of attempts, delay before the first retry
+# in seconds (doubled after each retry, up to max_backoff), random jitter added to each delay (as a
+# fraction of the delay), the HTTP status codes that are retried and whether the action is idempotent.
+# Requests that could not connect to the server are always retried. Timeouts waiting for the response,
+# dropped connections and the status codes are only retried for idempotent actions, which can safely run
+# twice, as the server may already have received the request. A failed part is resent on its own, with the
+# same part number.
+retry_policy = {
+    'attempts': 5,
+    'backoff': 2,
+    'max_backoff': 60,
+    'jitter': 0.5,
+    'status_codes': [408, 429, 500, 502, 503, 504],
+    'idempotent': False
+}
+# Per-action changes to retry_policy. Sending a part, resource_show and resource_patch again has the same
+# result; initiating a multipart upload again leaves an unused upload on the server, and finishing it again
+# fails once the first finish has joined the parts.
+action_retry_policies = {
+    'cloudstorage_upload_multipart': {'idempotent': True},
+    'cloudstorage_finish_multipart': {'attempts': 3},
+    'resource_show': {'idempotent': True},
+    'resource_patch': {'attempts': 3, 'idempotent': True}
+}
+
+# Names of the settings above, which can be changed with configure()
+setting_names = (
+    'ckan_base', 'ckan_api_key', 'chunk_size', 'adaptive_chunk_size', 'min_chunk_size', 'max_chunk_size',
+    'max_chunk_count', 'request_overhead', 'max_workers', 'resume_uploads', 'read_mode', 'read_ahead',
+    'max_files_in_flight', 'max_parts_in_flight', 'max_bytes_in_flight', 'upload_slots', 'assumed_throughput',
+    'verify_chunks', 'compute_file_hash', 'compression', 'compression_level', 'skip_unchanged', 'hash_field',
+    'progress_mode', 'progress_interval', 'metrics_location', 'pool_size', 'bandwidth_limit', 'bandwidth_schedule',
+    'request_timeout', 'retry_policy', 'action_retry_policies'
+)
+
+session = None
+session_pool_size = 0 # size of the connection pool of session
+session_lock = threading.Lock()
+
+# Progress reporter of the upload(s) in progress (see reportProgress)
+progress_reporter = None
+
+# Token bucket shared by all uploads (see getBandwidthLimit), created with the first request
+upload_bucket = None
+upload_bucket_lock = threading.Lock()
+
+# JSON-lines metrics file of this run (see recordMetric)
+metrics_path = None
+metrics_lock = threading.Lock()
+
+# Request latency (seconds) and upload throughput (bytes/second) measured from recent requests,
+# used by pickChunkSize
+transfer_stats = {'latency': None, 'throughput': None}
+transfer_stats_lock = threading.Lock()
+
+
+# Change settings of the uploader, e.g. configure(ckan_base='https://data.ca.gov', max_workers=4) from a
+# script that imports it, or configure(max_workers = 4) from R after source_python()
+def configure(**settings):
+    for name, value in settings.items():
+        if name not in setting_names:
+            raise TypeError('Unknown setting: {}'.format(name))
+        globals()[name] = value
+
+
+# Value of a setting for one call: the value passed to the function, or the current setting if None was
+# passed (so settings changed with configure() also change the defaults of the functions below)
+def getSetting(name, value=None):
+    return globals()[name] if value is None else value
+
+
+# Get the HTTP session shared by all CKAN action API requests, so connections (and their TLS
+# handshakes) are reused across parts, finish/patch calls and files in the same upload batch. The
+# connection pool is enlarged if more than its current size is requested; the upload functions ask for
+# the size they need before their upload threads start.
+def getSession(pool_size=None):
+    global session, session_pool_size
+    pool_size = getSetting('pool_size', pool_size)
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            session_pool_size = 0
+        if pool_size > session_pool_size:
+            # the smaller pool that is replaced is not closed, as other threads may still be sending requests
+            # over its connections; its connections are closed when it is garbage collected
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session_pool_size = pool_size
+        return session
+
+
+# Close the shared HTTP session and its connections (a new one is created by the next request)
+def closeSession():
+    global session, session_pool_size
+    with session_lock:
+        if session is not None:
+            session.close()
+            session = None
+            session_pool_size = 0
+
+
+# Update the measured latency / throughput with the time it took to send an action's request of
+# request_size bytes (both are moving averages). Latency is measured from initiate requests and small
+# parts, throughput from larger parts. Finish, patch and show requests are not measured, as their time
+# is mostly spent by the server (e.g. joining the parts of a file), not on the connection.
+def recordTransfer(action, request_size, elapsed):
+    if action == 'cloudstorage_initiate_multipart':
+        is_latency_sample = True
+    elif action == 'cloudstorage_upload_multipart':
+        is_latency_sample = request_size < 1024 * 64
+    else:
+        return
+    with transfer_stats_lock:
+        latency = transfer_stats['latency']
+        if is_latency_sample:
+            transfer_stats['latency'] = elapsed if latency is None else 0.7 * latency + 0.3 * elapsed
+        else:
+            send_time = max(elapsed - (latency or 0), elapsed * 0.1)
+            throughput = transfer_stats['throughput']
+            sample = request_size / send_time
+            transfer_stats['throughput'] = sample if throughput is None else 0.7 * throughput + 0.3 * sample
+
+
+# Pick the chunk size for a file: large enough that the per-request latency stays below
+# request_overhead of the time spent sending each chunk (at the measured throughput), and that the
+# file fits in max_chunk_count parts, within min_chunk_size/max_chunk_size. Files that fit in one
+# chunk are sent in a single part. Until latency and throughput have been measured (by earlier
+# requests), chunk_size is used as the starting point.
+def pickChunkSize(file_size):
+    with transfer_stats_lock:
+        latency = transfer_stats['latency']
+        throughput = transfer_stats['throughput']
+    if latency and throughput:
+        part_size = throughput * latency * (1 - request_overhead) / request_overhead
+    else:
+        part_size = chunk_size
+    part_size = max(part_size, math.ceil(float(file_size) / max_chunk_count), min_chunk_size)
+    part_size = min(part_size, max_chunk_size)
+    if file_size <= part_size:
+        return max(file_size, 1)
+    # spread the file evenly over the parts (rounded up to a whole MB) to avoid a small last part
+    part_count = math.ceil(float(file_size) / part_size)
+    balanced_size = math.ceil(float(file_size) / part_count / 1024 ** 2) * 1024 ** 2
+    if min_chunk_size <= balanced_size <= max_chunk_size:
+        return balanced_size
+    return int(part_size)
+
+
+# Path of the metrics file of this run (created in metrics_location on the first call), or None if
+# metrics are not being recorded
+def getMetricsPath():
+    global metrics_path
+    if metrics_location is None:
+        return None
+    if metrics_path is None:
+        os.makedirs(metrics_location, exist_ok=True)
+        metrics_path = os.path.join(metrics_location, 'upload-metrics_{}.jsonl'.format(
+            time.strftime('%Y-%m-%d_%H-%M-%S')))
+    return metrics_path
+
+
+# Append a record (a dict with an 'event' key: 'request', 'upload' or 'batch') to the metrics file of
+# this run, one JSON object per line
+def recordMetric(record):
+    with metrics_lock:
+        path = getMetricsPath()
+        if path is None:
+            return
+        record = dict(record, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        try:
+            with open(path, 'a') as metrics_file:
+                metrics_file.write(json.dumps(record) + '\n')
+        except OSError as e:
+            print('Unable to write metrics to {0}: {1}'.format(path, e))
+
+
+# Add the time spent in a phase of an upload ('hash', 'initiate', 'parts', 'finish' or 'patch') to the
+# upload's phase durations, reported in its metrics when the upload is done
+@contextlib.contextmanager
+def timePhase(upload, phase):
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        upload['phases'][phase] = upload['phases'].get(phase, 0) + time.monotonic() - start_time
+
+
+# Record the metrics of a finished (or failed) upload: size, time, throughput and time spent in each phase
+def recordUploadMetrics(upload, success):
+    seconds = time.monotonic() - upload['start_time']
+    recordMetric({
+        'event': 'upload',
+        'resource_id': upload['resource_id'],
+        'upload_id': upload.get('upload_id'),
+        'file': upload['file_name'],
+        'bytes': upload.get('file_size'),
+        'chunk_size': upload.get('chunk_size'),
+        'parts': upload.get('chunk_count'),
+        'parts_sent': len(upload['new_parts']),
+        'parts_resumed': len(upload['previous_parts']),
+        'skipped': upload['skipped'],
+        'success': success,
+        'seconds': round(seconds, 3),
+        'mb_per_second': round((upload.get('file_size') or 0) / max(seconds, 1e-6) / 1024 ** 2, 3),
+        'phases': {phase: round(duration, 3) for phase, duration in upload['phases'].items()}
+    })
+
+
+# Get the retry settings for an action (retry_policy with the action's entry in action_retry_policies applied)
+def getRetryPolicy(action):
+    policy = dict(retry_policy)
+    policy.update(action_retry_policies.get(action, {}))
+    return policy
+
+
+# Seconds to wait before retry number `retry` (1 = first retry) under the given retry policy
+def getRetryDelay(policy, retry):
+    delay = min(policy['backoff'] * 2 ** (retry - 1), policy['max_backoff'])
+    return delay + random.uniform(0, policy['jitter'] * delay)
+
+
+# True if a request failed before it was sent, because no connection to the server could be made (so the
+# server has not received it)
+def isConnectError(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return (isinstance(error, requests.exceptions.ConnectionError) and
+            isinstance(reason, (NewConnectionError, ConnectTimeoutError)))
+
+
+# Post request to CKAN action API, retrying connection errors, timeouts and retryable HTTP status codes
+# according to the action's retry policy (only failures to connect if the action is not idempotent).
+# Returns the parsed response, or {'success': False, 'error': ...} if the request could not be completed.
+# With report_progress, the bytes sent are added to the progress of the upload(s) in progress.
+def ckanRequest(action, data_dict, ckan_api_key=None, report_progress=False):
+    ckan_api_key = getSetting('ckan_api_key', ckan_api_key)
+    policy = getRetryPolicy(action)
+    attempts = max(int(policy['attempts']), 1)
+    metric = {
+        'event': 'request',
+        'action': action,
+        'resource_id': data_dict.get('id'),
+        'upload_id': data_dict.get('uploadId'),
+        'part_number': int(data_dict['partNumber']) if 'partNumber' in data_dict else None,
+        'start': round(time.time(), 3),
+        'status': None
+    }
+    request_start = time.monotonic()
+
+    # record the request's metrics (time including retries, last HTTP status, attempts) and return its response
+    def done(response, attempt):
+        metric.update({
+            'bytes': encoder.len,
+            'seconds': round(time.monotonic() - request_start, 3),
+            'attempts': attempt,
+            'success': bool(response.get('success')) if isinstance(response, dict) else False,
+            'error': response.get('error') if isinstance(response, dict) else None
+        })
+        recordMetric(metric)
+        return response
+
+    for attempt in range(1, attempts + 1):
+        # rewind file-like values (e.g. streamed chunks) that were partly sent by a failed attempt
+        for value in data_dict.values():
+            if isinstance(value, tuple) and hasattr(value[1], 'seek'):
+                value[1].seek(0)
+        encoder = MultipartEncoder(fields=data_dict)
+        progress = progress_reporter if report_progress else None
+        # when a limit is set for any time of day, every request goes through the token bucket, which checks
+        # the bandwidth limit for each block sent, so a request that started outside a limited period is
+        # slowed down once the period begins
+        bucket = getUploadBucket() if isBandwidthLimited() else None
+        body = MultipartEncoderMonitor(encoder, getCallback(progress, bucket))
+        try:
+            start_time = time.monotonic()
+            r = getSession().post(
+                    '{ckan_base}/api/action/{action}'.format(ckan_base=ckan_base, action=action),
+                    data=body,
+                    headers={
+                        'Content-Type' : encoder.content_type,
+                        'X-CKAN-API-Key': ckan_api_key
+                    },
+                    timeout=request_timeout
+                )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            error = '{0}: {1}'.format(type(e).__name__, e)
+            if not (policy.get('idempotent') or isConnectError(e)):
+                print('{0} request failed ({1}) - not retried, as the server may have received it'.format(
+                    action, error))
+                return done({'success': False, 'error': error}, attempt)
+        except requests.exceptions.RequestException as e:
+            print('{0} request failed - {1}: {2}'.format(action, type(e).__name__, e))
+            return done({'success': False, 'error': str(e)}, attempt)
+        else:
+            metric['status'] = r.status_code
+            if r.status_code not in policy['status_codes'] or not policy.get('idempotent'):
+                recordTransfer(action, encoder.len, time.monotonic() - start_time)
+                try:
+                    return done(r.json(), attempt)
+                except ValueError:
+                    print(r.text)
+                    return done({'success': False, 'error': 'HTTP {} (response is not JSON)'.format(r.status_code)},
+                                attempt)
+            error = 'HTTP {}'.format(r.status_code)
+        if progress is not None:
+            # the data will be sent again, so take this attempt back out of the progress
+            progress.advance(-body.bytes_read)
+        if attempt < attempts:
+            delay = getRetryDelay(policy, attempt)
+            print('{0} request failed ({1}) - retrying in {2:.1f} seconds (attempt {3} of {4})'.format(
+                action, error, delay, attempt + 1, attempts))
+            time.sleep(delay)
+    print('{0} request failed after {1} attempts ({2})'.format(action, attempts, error))
+    return done({'success': False, 'error': error}, attempts)
+
+
+# Callback for MultipartEncoderMonitor, called each time the encoder has read a block of the request:
+# adds the bytes read since its last call to the progress reporter and, when uploads are limited, waits
+# for the bandwidth to send them
+def getCallback(progress, bucket=None):
+    bytes_reported = [0]
+
+    def callback(monitor):
+        size = monitor.bytes_read - bytes_reported[0]
+        bytes_reported[0] = monitor.bytes_read
+        if progress is not None:
+            progress.advance(size)
+        if bucket is not None:
+            bucket.consume(size)
+
+    return callback
+
+
+# Upload speed limit in bytes/second at the current time of day (from bandwidth_schedule, or
+# bandwidth_limit outside its periods), or None if uploads are not limited
+def getBandwidthLimit():
+    now = time.strftime('%H:%M')
+    limit = bandwidth_limit
+    for start, end, period_limit in bandwidth_schedule:
+        if (start <= now < end) if start < end else (now >= start or now < end):
+            limit = period_limit
+            break
+    return limit * 1024 ** 2 if limit else None
+
+
+# True if uploads are limited at any time of day (by bandwidth_limit or a period of bandwidth_schedule)
+def isBandwidthLimited():
+    return bool(bandwidth_limit) or any(period_limit for start, end, period_limit in bandwidth_schedule)
+
+
+# Token bucket limiting the rate at which bytes are sent. The rate is read from getBandwidthLimit() on
+# each call, so schedule changes apply to uploads in progress. Up to one second of unused bandwidth can
+# be saved up, so short pauses (e.g. between parts) do not lower the average speed.
+class TokenBucket(object):
+    def __init__(self):
+        self.tokens = 0.0
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take `size` bytes from the bucket, waiting until they are covered by the rate limit. Threads
+    # that go over the limit wait in proportion to the bytes they have taken, so every part gets its
+    # share of the bandwidth. Returns at once when uploads are not limited at the current time.
+    def consume(self, size):
+        rate = getBandwidthLimit()
+        if rate is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last_time) * rate, rate)
+            self.last_time = now
+            self.tokens -= size
+            delay = -self.tokens / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Get the token bucket shared by all uploads
+def getUploadBucket():
+    global upload_bucket
+    with upload_bucket_lock:
+        if upload_bucket is None:
+            upload_bucket = TokenBucket()
+        return upload_bucket
+
+
+# Single progress line for everything being uploaded (all parts of all files), updated at most once
+# every progress_interval seconds no matter how often advance() is called. Nothing is shown in silent mode.
+class ProgressReporter(object):
+    def __init__(self, total_bytes=0):
+        self.total_bytes = total_bytes
+        self.bytes_sent = 0
+        self.silent = progress_mode == 'silent'
+        self.is_terminal = sys.stdout is not None and hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+        self.interval = progress_interval if self.is_terminal else 30
+        self.start_time = time.monotonic()
+        self.last_update = self.start_time
+        self.lock = threading.Lock()
+
+    def advance(self, size):
+        with self.lock:
+            self.bytes_sent += size
+            now = time.monotonic()
+            if self.silent or now - self.last_update < self.interval:
+                return
+            self.last_update = now
+            self.show(now)
+
+    def show(self, now, end=False):
+        elapsed = max(now - self.start_time, 1e-6)
+        line = '{0:.1f}MB'.format(self.bytes_sent / 1024 ** 2)
+        if self.total_bytes:
+            line += ' of {0:.1f}MB ({1:.0%})'.format(self.total_bytes / 1024 ** 2,
+                                                     min(self.bytes_sent / self.total_bytes, 1))
+        line += ' sent - {0:.2f}MB/s'.format(self.bytes_sent / elapsed / 1024 ** 2)
+        if self.is_terminal and not end:
+            click.echo('\r' + line, nl=False)
+        else:
+            click.echo(('\r' if self.is_terminal else '') + line)
+
+    def finish(self):
+        with self.lock:
+            if not self.silent and self.bytes_sent:
+                self.show(time.monotonic(), end=True)
+
+
+# Report the progress of an upload (or a batch of uploads) of total_bytes bytes. Uploads started while
+# another upload's progress is being reported (e.g. the files of a batch) are added to the same progress line.
+@contextlib.contextmanager
+def reportProgress(total_bytes):
+    global progress_reporter
+    if progress_reporter is not None:
+        yield progress_reporter
+        return
+    progress_reporter = ProgressReporter(total_bytes)
+    try:
+        yield progress_reporter
+    finally:
+        progress_reporter.finish()
+        progress_reporter = None
+
+
+# Whether per-chunk messages ('Uploading chunk ...') are printed: not in silent mode, and not while a progress
+# line is being redrawn on a terminal, as they would break it up (they are printed to a log file)
+def showChunkMessages():
+    reporter = progress_reporter
+    return progress_mode != 'silent' and not (reporter is not None and reporter.is_terminal)
+
+
+# Read file in chunks
+def readInChunks(file_object, chunk_size=None):
+    chunk_size = getSetting('chunk_size', chunk_size)
+    while True:
+        data = file_object.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+# Read part of a file (with its own file handle, so parts can be read from several threads at once)
+def readPart(file_path, offset, length):
+    with open(file_path, 'rb') as part_file:
+        part_file.seek(offset)
+        return part_file.read(length)
+
+
+# File-like object that reads the compressed contents of file_path. The file is compressed by a
+# background thread into a small queue of compressed blocks, so compression overlaps with sending the
+# parts, and no compressed copy of the file is ever written to disk or held in memory as a whole.
+class CompressedFileReader(object):
+    extensions = {'gzip': '.gz', 'zip': '.zip', 'zstd': '.zst'}
+
+    def __init__(self, file_path, compression, member_name=None, block_size=1024 * 1024):
+        if compression not in self.extensions:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('compression = \'zstd\' needs the zstandard package (pip install zstandard)')
+        self.blocks = queue.Queue(maxsize=16)
+        self.buffer = bytearray()
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.bytes_read = 0
+        self.thread = threading.Thread(target=self.compress, daemon=True,
+                                       args=(file_path, compression, member_name or os.path.basename(file_path), block_size))
+        self.thread.start()
+
+    # Called by the compressor (in the background thread) with each block of compressed data
+    def write(self, data):
+        data = bytes(data)
+        while data:
+            if self.closed:
+                raise ValueError('Compressed upload stopped')
+            try:
+                self.blocks.put(data, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def compress(self, file_path, compression, member_name, block_size):
+        try:
+            with open(file_path, 'rb') as source:
+                if compression == 'gzip':
+                    with gzip.GzipFile(filename=member_name, mode='wb', fileobj=self, compresslevel=compression_level, mtime=0) as target:
+                        for block in readInChunks(source, block_size):
+                            target.write(block)
+                elif compression == 'zip':
+                    with zipfile.ZipFile(self, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compression_level) as archive:
+                        with archive.open(member_name, 'w', force_zip64=True) as target:
+                            for block in readInChunks(source, block_size):
+                                target.write(block)
+                else:
+                    with zstandard.ZstdCompressor().stream_writer(self, closefd=False) as target:
+                        for block in readInChunks(source, block_size):
+                            target.write(block)
+        except Exception as e:
+            self.error = e
+        finally:
+            while not self.closed:
+                try:
+                    self.blocks.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.finished:
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+            else:
+                self.buffer += block
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+    # Stop the compression (e.g. after a failed upload) and wait for the background thread to finish
+    def close(self):
+        self.closed = True
+        self.thread.join()
+
+
+# File-like reader over an iterable of blocks (bytes, or str encoded as UTF-8) of unknown total length,
+# e.g. the rows of a CSV file as they are written, so they can be uploaded with uploadStream without
+# being saved to a file first. Only the blocks needed for the next read are held in memory.
+class IterableReader(object):
+    def __init__(self, blocks, encoding='utf-8'):
+        self.blocks = iter(blocks)
+        self.encoding = encoding
+        self.buffer = bytearray()
+        self.finished = False
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.finished:
+            try:
+                block = next(self.blocks)
+            except StopIteration:
+                self.finished = True
+                break
+            if isinstance(block, str):
+                block = block.encode(self.encoding)
+            self.buffer += block
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+    # Stop reading the blocks (closes the iterable if it is a generator, e.g. after a failed upload)
+    def close(self):
+        self.finished = True
+        if hasattr(self.blocks, 'close'):
+            self.blocks.close()
+
+
+# Read the chunks of a file that have not been uploaded yet, as (part_number, chunk) pairs
+def readMissingChunks(file_object, chunk_count, completed_parts=(), chunk_size=None):
+    chunk_size = getSetting('chunk_size', chunk_size)
+    for part_number in range(1, chunk_count + 1):
+        if part_number in completed_parts:
+            continue
+        file_object.seek((part_number - 1) * chunk_size)
+        yield part_number, file_object.read(chunk_size)
+
+
+# Read chunks in a background thread, up to `depth` chunks ahead of the upload, so the next chunk is
+# read from disk while the current chunk is being sent
+def readAhead(chunks, depth=None):
+    depth = getSetting('read_ahead', depth)
+    prefetched = queue.Queue()
+    free_slots = threading.Semaphore(int(depth))
+    stop = threading.Event()
+    end_of_chunks = object()
+
+    def reader():
+        try:
+            chunk_iterator = iter(chunks)
+            while True:
+                while not free_slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                item = next(chunk_iterator, None)
+                if item is None:
+                    break
+                prefetched.put(item)
+        except Exception as e:
+            prefetched.put(e)
+        finally:
+            prefetched.put(end_of_chunks)
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        while True:
+            item = prefetched.get()
+            if item is end_of_chunks:
+                break
+            if isinstance(item, Exception):
+                raise item
+            free_slots.release()
+            yield item
+    finally:
+        stop.set()
+        reader_thread.join()
+
+
+# File-like view over a slice of a memory-mapped file, handed to MultipartEncoder in place of a
+# chunk so the part is paged in from the file as it is sent rather than copied into a new bytes
+# object (close() releases the view so the memory map can be closed)
+class MemoryviewReader(object):
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    @property
+    def len(self):
+        return len(self.view) - self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        data = self.view[self.position:self.position + size].tobytes()
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = min(max(offset, 0), len(self.view))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.view.release()
+
+
+# Same as readMissingChunks, but for a memory-mapped file: each chunk is a MemoryviewReader over
+# the part's slice of the map instead of a bytes copy
+def readMissingChunksMmap(mapped_file, chunk_count, completed_parts=(), chunk_size=None):
+    chunk_size = getSetting('chunk_size', chunk_size)
+    for part_number in range(1, chunk_count + 1):
+        if part_number in completed_parts:
+            continue
+        start = (part_number - 1) * chunk_size
+        yield part_number, MemoryviewReader(memoryview(mapped_file)[start:start + chunk_size])
+
+
+# Seekable, length-limited file-like view over the bytes of file_path from offset to offset + length,
+# handed to MultipartEncoder in place of a chunk so the part is streamed from disk to the connection
+# in small blocks (memory use does not grow with chunk_size). Each window opens its own file handle
+# when it is first read, so parts uploaded at the same time do not share a file position.
+class FileWindowReader(object):
+    def __init__(self, file_path, offset, length):
+        self.file_path = file_path
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        self.file_object = None
+
+    @property
+    def len(self):
+        return self.length - self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.len:
+            size = self.len
+        if size == 0:
+            return b''
+        if self.file_object is None:
+            self.file_object = open(self.file_path, 'rb')
+        self.file_object.seek(self.offset + self.position)
+        data = self.file_object.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.file_object is not None:
+            self.file_object.close()
+            self.file_object = None
+
+
+# Same as readMissingChunks, but each chunk is a FileWindowReader over the part's byte range of the
+# file instead of a bytes copy
+def readMissingChunksStream(file_path, file_size, chunk_count, completed_parts=(), chunk_size=None):
+    chunk_size = getSetting('chunk_size', chunk_size)
+    for part_number in range(1, chunk_count + 1):
+        if part_number in completed_parts:
+            continue
+        start = (part_number - 1) * chunk_size
+        yield part_number, FileWindowReader(file_path, start, min(chunk_size, file_size - start))
+
+
+# File opened once for thread-safe reads at given offsets. os.pread reads from an offset without using
+# (or moving) a shared file position, so any number of upload threads can read their parts of the same
+# file at once; where os.pread is not available (Windows), each read seeks and reads under a lock.
+class PositionalFile(object):
+    def __init__(self, file_path):
+        self.file_object = open(file_path, 'rb', buffering=0)
+        self.lock = threading.Lock()
+
+    def readAt(self, offset, length):
+        blocks = []
+        while length > 0:
+            if hasattr(os, 'pread'):
+                block = os.pread(self.file_object.fileno(), length, offset)
+            else:
+                with self.lock:
+                    self.file_object.seek(offset)
+                    block = self.file_object.read(length)
+            if not block:
+                break
+            blocks.append(block)
+            offset += len(block)
+            length -= len(block)
+        return blocks[0] if len(blocks) == 1 else b''.join(blocks)
+
+    def close(self):
+        self.file_object.close()
+
+
+# Chunk of a PositionalFile, handed to MultipartEncoder in place of a bytes copy. The whole part is read
+# with one positional read when it is first sent, in the upload thread sending it, so parts are read in
+# parallel from their own offsets instead of one after the other; the data is released by close().
+class PositionalPartReader(object):
+    def __init__(self, positional_file, offset, length):
+        self.positional_file = positional_file
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        self.data = None
+
+    @property
+    def len(self):
+        return self.length - self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.len:
+            size = self.len
+        if size == 0:
+            return b''
+        if self.data is None:
+            self.data = memoryview(self.positional_file.readAt(self.offset, self.length))
+        data = self.data[self.position:self.position + size].tobytes()
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.data = None
+
+
+# Same as readMissingChunks, but each chunk is a PositionalPartReader, read by the thread that uploads it
+def readMissingChunksPread(positional_file, file_size, chunk_count, completed_parts=(), chunk_size=None):
+    chunk_size = getSetting('chunk_size', chunk_size)
+    for part_number in range(1, chunk_count + 1):
+        if part_number in completed_parts:
+            continue
+        start = (part_number - 1) * chunk_size
+        yield part_number, PositionalPartReader(positional_file, start, min(chunk_size, file_size - start))
+
+
+# Hash of a file's contents ('sha256:<hex digest>'), read in blocks so large files are never held in memory
+def getFileHash(file_path, block_size=1024 * 1024):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as hash_file:
+        for block in readInChunks(hash_file, block_size):
+            file_hash.update(block)
+    return 'sha256:' + file_hash.hexdigest()
+
+
+# Check (with resource_show) whether the resource's current file has the same size and hash as the
+# file to upload, i.e. the file has not changed since it was last uploaded (only the hash is compared
+# if file_size is None, e.g. for compressed uploads, where the resource's size is the compressed size)
+def isResourceUnchanged(resource_id, file_size, file_hash, ckan_api_key):
+    show_response = ckanRequest('resource_show', {'id': resource_id}, ckan_api_key)
+    if not show_response.get('success'):
+        print('Unable to get resource metadata - the file will be uploaded')
+        return False
+    resource = show_response.get('result') or {}
+    if file_size is None:
+        return resource.get(hash_field) == file_hash
+    try:
+        stored_size = int(resource.get('size'))
+    except (TypeError, ValueError):
+        return False
+    return stored_size == file_size and resource.get(hash_field) == file_hash
+
+
+# Check (with resource_show) whether the resource already holds the file of an upload that the server no
+# longer has, i.e. an earlier finish request whose response was lost (to a timeout or an interrupted run)
+# has joined the parts: the resource's file has the name and size of the uploaded file, and it has been
+# modified since the upload was initiated or its hash is the hash of the uploaded file (a same-named,
+# same-sized file from an earlier upload, e.g. a dated export of a fixed size, passes neither check).
+# Returns False if this can not be confirmed, or None if the resource could not be read.
+def isUploadFinished(upload, ckan_api_key):
+    show_response = ckanRequest('resource_show', {'id': upload['resource_id']}, ckan_api_key)
+    if not show_response.get('success'):
+        print('Unable to get resource metadata')
+        return None
+    resource = show_response.get('result') or {}
+    try:
+        stored_size = int(resource.get('size'))
+    except (TypeError, ValueError):
+        return False
+    stored_name = (resource.get('url') or '').rsplit('/', 1)[-1]
+    if stored_name != upload['file_name'] or stored_size != upload['file_size']:
+        return False
+    journal = upload['journal']
+    if ('resource_last_modified' in journal and
+            resource.get('last_modified') not in (None, journal['resource_last_modified'])):
+        return True
+    if not resource.get(hash_field):
+        return False
+    if not upload['file_hash']:
+        checksums = upload['checksums']
+        with timePhase(upload, 'hash'):
+            upload['file_hash'] = ((checksums.getFileHash() if checksums is not None else None) or
+                                   getFileHash(upload['file_path']))
+    return resource.get(hash_field) == upload['file_hash']
+
+
+# Location of the journal that records the progress of a multipart upload of file_path
+def getJournalPath(file_path):
+    return file_path + '.upload-journal.json'
+
+
+# Get the journal of an earlier, unfinished upload of the same file to the same resource (returns
+# None if there is no journal or the file has changed since the journal was written; the chunk size
+# is only checked if one is given)
+def readJournal(file_path, resource_id, file_size, file_mtime, chunk_size=None):
+    try:
+        with open(getJournalPath(file_path)) as journal_file:
+            journal = json.load(journal_file)
+    except (OSError, ValueError):
+        return
+    if (journal.get('resource_id') != resource_id or journal.get('file_size') != file_size or
+            journal.get('file_mtime') != file_mtime or chunk_size not in (None, journal.get('chunk_size'))):
+        print('Ignoring upload journal for {} (file or settings have changed)'.format(os.path.basename(file_path)))
+        return
+    return journal
+
+
+# Save the journal (written to a temporary file first so an interruption never leaves a partial journal).
+# Returns False if it can not be written, e.g. if the folder of the file is read-only.
+def writeJournal(file_path, journal):
+    journal_path = getJournalPath(file_path)
+    try:
+        with open(journal_path + '.tmp', 'w') as journal_file:
+            json.dump(journal, journal_file)
+        os.replace(journal_path + '.tmp', journal_path)
+    except OSError as e:
+        print('Unable to write upload journal for {0} ({1}) - the upload can not be resumed if it is '
+              'interrupted'.format(os.path.basename(file_path), e))
+        return False
+    return True
+
+
+def removeJournal(file_path):
+    try:
+        os.remove(getJournalPath(file_path))
+    except OSError:
+        pass
+
+
+# MD5 of each part and SHA-256 of the whole file, computed by a background thread that reads the file on
+# its own, in order, while the parts are being sent (in any read_mode, and including the parts sent
+# before a resumed upload was interrupted). The file is usually read from the operating system's cache,
+# right behind the upload, and hashing does not hold up the threads sending the parts.
+class FileChecksums(object):
+    def __init__(self, file_path, chunk_size, part_md5=True, file_hash=True, block_size=1024 * 1024):
+        self.part_md5 = part_md5
+        self.part_md5s = {}
+        self.file_hash = None
+        self.error = None
+        self.finished = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.compute, args=(file_path, chunk_size, part_md5, file_hash, block_size),
+                                       daemon=True)
+        self.thread.start()
+
+    def compute(self, file_path, chunk_size, part_md5, file_hash, block_size):
+        file_sha256 = hashlib.sha256() if file_hash else None
+        part_number = 0
+        try:
+            with open(file_path, 'rb') as checksum_file:
+                while not self.closed:
+                    part_hash = hashlib.md5() if part_md5 else None
+                    remaining = chunk_size
+                    while remaining > 0 and not self.closed:
+                        block = checksum_file.read(min(block_size, remaining))
+                        if not block:
+                            break
+                        remaining -= len(block)
+                        if part_hash is not None:
+                            part_hash.update(block)
+                        if file_sha256 is not None:
+                            file_sha256.update(block)
+                    if remaining == chunk_size or self.closed:
+                        break
+                    part_number += 1
+                    if part_hash is not None:
+                        with self.condition:
+                            self.part_md5s[part_number] = part_hash.hexdigest()
+                            self.condition.notify_all()
+            if file_sha256 is not None and not self.closed:
+                self.file_hash = 'sha256:' + file_sha256.hexdigest()
+        except OSError as e:
+            self.error = e
+            print('Unable to compute checksums of {0}: {1}'.format(file_path, e))
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    # MD5 (hex) of a part, waiting for it to be computed (None if it could not be computed, or at once if
+    # part MD5s are not being computed, so parts never wait for the file hash)
+    def getPartMd5(self, part_number):
+        if not self.part_md5:
+            return None
+        with self.condition:
+            self.condition.wait_for(lambda: part_number in self.part_md5s or self.finished)
+            return self.part_md5s.get(part_number)
+
+    # 'sha256:<hex>' hash of the whole file, waiting for it to be computed (None if it could not be computed)
+    def getFileHash(self):
+        self.thread.join()
+        return self.file_hash
+
+    # Stop computing the checksums (e.g. after a failed upload)
+    def close(self):
+        self.closed = True
+
+
+# Whether a failed CKAN response says that the multipart upload (or its resource) no longer exists, e.g.
+# after the server has expired an unfinished upload (HTTP 5xx errors, timeouts and connection errors do not)
+def isUploadMissing(response):
+    error = response.get('error') if isinstance(response, dict) else None
+    return isinstance(error, dict) and error.get('__type') == 'Not Found Error'
+
+
+# Upload a single chunk as one part of a multipart upload. The chunk's MD5 (md5, or computed by checksums)
+# is compared with the ETag of the stored part, when the server returns one. on_upload_missing, if given,
+# is called when the server no longer has the multipart upload.
+def uploadChunk(resource_id, upload_id, part_number, file_name, chunk, ckan_api_key, md5=None, checksums=None,
+                on_upload_missing=None):
+    upload_dict = {
+        'id': resource_id,
+        'uploadId': upload_id,
+        'partNumber': str(part_number),
+        'upload': (file_name, chunk, 'text/plain')
+    }
+    if showChunkMessages():
+        print('Uploading chunk {}'.format(part_number))
+    try:
+        upload_response = ckanRequest('cloudstorage_upload_multipart', upload_dict, ckan_api_key, report_progress=True)
+    finally:
+        if hasattr(chunk, 'close'):
+            chunk.close()
+    if upload_response and upload_response.get('success'):
+        # compare the chunk's MD5 with the ETag of the stored part, when the server returns one
+        result = upload_response.get('result') or {}
+        etag = (result.get('ETag') or result.get('etag')) if isinstance(result, dict) else None
+        if etag and md5 is None and checksums is not None:
+            md5 = checksums.getPartMd5(part_number)
+        if md5 and etag and etag.strip('"') != md5:
+            print('Error uploading chunk {0} - checksum mismatch (sent {1}, server has {2})'.format(part_number, md5, etag))
+            return False
+        if showChunkMessages():
+            print('Chunk {} sent to server\n'.format(part_number))
+        return True
+    else:
+        print('Error uploading chunk {}'.format(part_number))
+        if on_upload_missing is not None and isUploadMissing(upload_response):
+            on_upload_missing()
+        return False
+
+
+# Upload (part_number, chunk) pairs with at most max_workers chunks in flight (and in memory) at
+# once; stops handing out new chunks after the first failure and returns the set of part numbers
+# that were uploaded successfully (on_part_uploaded, if given, is called with each of them as
+# soon as the part has been sent). Parts are checked against checksums (a FileChecksums), if given.
+def uploadChunks(resource_id, upload_id, file_name, chunks, ckan_api_key, max_workers=None,
+                 on_part_uploaded=None, checksums=None, on_upload_missing=None):
+    max_workers = int(getSetting('max_workers', max_workers))
+    completed_parts = set()
+    failed = False
+
+    def partUploaded(part_number):
+        completed_parts.add(part_number)
+        if on_part_uploaded is not None:
+            on_part_uploaded(part_number)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        for part_number, chunk in chunks:
+            future = executor.submit(uploadChunk, resource_id, upload_id, part_number, file_name, chunk, ckan_api_key,
+                                     None, checksums, on_upload_missing)
+            in_flight[future] = part_number
+            del chunk
+            while len(in_flight) >= max_workers or (failed and in_flight):
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    part_number = in_flight.pop(future)
+                    try:
+                        success = future.result()
+                    except Exception as e:
+                        print('Error uploading chunk {0}: {1}'.format(part_number, e))
+                        success = False
+                    if success:
+                        partUploaded(part_number)
+                    else:
+                        failed = True
+            if failed:
+                break
+        for future in concurrent.futures.as_completed(in_flight):
+            try:
+                if future.result():
+                    partUploaded(in_flight[future])
+            except Exception as e:
+                print('Error uploading chunk {0}: {1}'.format(in_flight[future], e))
+    return completed_parts
+
+
+# Prepare the upload of a file: check whether it can be skipped, then continue an earlier upload of
+# the file if it was interrupted (with the chunk size it was started with) or initiate a new multipart
+# upload to get upload_id. Returns a dict describing the upload (with 'skipped' set if the resource
+# already holds the file), or None if the multipart upload could not be initiated.
+def startUpload(resource_id, file_path, ckan_api_key, resume=None, skip_unchanged=None, verify_chunks=None):
+    resume = getSetting('resume_uploads', resume)
+    skip_unchanged = getSetting('skip_unchanged', skip_unchanged)
+    verify_chunks = getSetting('verify_chunks', verify_chunks)
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    file_mtime = os.path.getmtime(file_path)
+    upload = {
+        'resource_id': resource_id,
+        'file_path': file_path,
+        'file_name': file_name,
+        'file_size': file_size,
+        'file_hash': None,
+        'resume': resume,
+        'skipped': False,
+        'previous_parts': set(),
+        'new_parts': set(),
+        'missing': False,
+        'checksums': None,
+        'phases': {},
+        'start_time': time.monotonic()
+    }
+
+    # Skip the upload if the resource already holds this file
+    if skip_unchanged:
+        with timePhase(upload, 'hash'):
+            upload['file_hash'] = getFileHash(file_path)
+        if isResourceUnchanged(resource_id, file_size, upload['file_hash'], ckan_api_key):
+            print('{} has not changed since it was last uploaded - skipping upload'.format(file_name))
+            upload['skipped'] = True
+            if progress_reporter is not None:
+                progress_reporter.advance(file_size)
+            return upload
+
+    journal = None
+    if resume:
+        journal = readJournal(file_path, resource_id, file_size, file_mtime,
+                              None if adaptive_chunk_size else chunk_size)
+    if journal:
+        file_chunk_size = journal['chunk_size']
+    elif adaptive_chunk_size:
+        file_chunk_size = pickChunkSize(file_size)
+        print('Chunk size for {0}: {1:.1f}MB'.format(file_name, file_chunk_size / 1024 ** 2))
+    else:
+        file_chunk_size = chunk_size
+    chunk_count = math.ceil(float(file_size) / file_chunk_size)
+
+    if journal:
+        print('Resuming upload of {0}\n{1} of {2} chunks already sent\n'.format(
+            file_name, len(journal['completed_parts']), chunk_count))
+    else:
+        init_dict = {
+            'id': resource_id,
+            'name': file_name,
+            'size': str(file_size)
+        }
+        with timePhase(upload, 'initiate'):
+            # the resource's last modified date before the upload, so isUploadFinished can tell whether a
+            # later change to the resource was made by this upload
+            show_response = ckanRequest('resource_show', {'id': resource_id}, ckan_api_key)
+            init_response = ckanRequest('cloudstorage_initiate_multipart', init_dict, ckan_api_key)
+        if init_response.get('success'):
+            print('Ready to upload {0}\n{1} chunks\n'.format(file_name, chunk_count))
+        else:
+            print('Unable to initiate multipart upload')
+            return
+        journal = {
+            'resource_id': resource_id,
+            'upload_id': init_response.get('result', {}).get('id'),
+            'file_size': file_size,
+            'file_mtime': file_mtime,
+            'chunk_size': file_chunk_size,
+            'completed_parts': []
+        }
+        if show_response.get('success'):
+            journal['resource_last_modified'] = (show_response.get('result') or {}).get('last_modified')
+        if resume and not writeJournal(file_path, journal):
+            upload['resume'] = False
+
+    upload.update({
+        'upload_id': journal['upload_id'],
+        'chunk_size': file_chunk_size,
+        'chunk_count': chunk_count,
+        'journal': journal,
+        'previous_parts': set(journal['completed_parts'])
+    })
+    # compute the part MD5s and the file's hash while the parts are being sent
+    file_hash = compute_file_hash and not upload['file_hash']
+    if verify_chunks or file_hash:
+        upload['checksums'] = FileChecksums(file_path, file_chunk_size, verify_chunks, file_hash)
+
+    # parts sent before the upload was interrupted count as already uploaded
+    if progress_reporter is not None:
+        progress_reporter.advance(sum(min(file_chunk_size, file_size - (part_number - 1) * file_chunk_size)
+                                      for part_number in upload['previous_parts']))
+    return upload
+
+
+# Record that a part of the upload has been sent (and save it in the upload's journal)
+def recordUploadedPart(upload, part_number):
+    upload['new_parts'].add(part_number)
+    if upload['resume']:
+        upload['journal']['completed_parts'].append(part_number)
+        if not writeJournal(upload['file_path'], upload['journal']):
+            upload['resume'] = False
+
+
+# Record that the server no longer has the multipart upload, so its journal is discarded by finishUpload
+def recordUploadMissing(upload):
+    upload['missing'] = True
+
+
+# Finish the upload once every part has been sent: convert the uploaded parts into a single file and
+# update the resource. Returns True if the resource has been updated (or the upload was skipped).
+def finishUpload(upload, ckan_api_key):
+    checksums = upload.get('checksums')
+
+    # stop computing checksums, record the upload's metrics and return whether it succeeded
+    def done(success):
+        if checksums is not None:
+            checksums.close()
+        recordUploadMetrics(upload, success)
+        return success
+
+    if upload['skipped']:
+        return done(True)
+    resource_id = upload['resource_id']
+    file_path = upload['file_path']
+    file_name = upload['file_name']
+    previous_parts = upload['previous_parts']
+    new_parts = upload['new_parts']
+
+    # Only finish the upload once every part number has been sent successfully
+    missing_parts = sorted(set(range(1, upload['chunk_count'] + 1)) - previous_parts - new_parts)
+    if missing_parts:
+        print('Error uploading {0} - chunks not sent to server: {1}'.format(file_name, missing_parts))
+        if file_path is None:
+            pass
+        elif upload['missing']:
+            # the server no longer has the earlier upload, so start over next time
+            print('Discarding upload journal for {}'.format(file_name))
+            removeJournal(file_path)
+        elif upload['resume']:
+            print('Run the upload again to send the remaining chunks')
+        return done(False)
+
+    # Finish upload by converting separate uploaded parts into single file
+    finish_dict = {
+        'uploadId': upload['upload_id'],
+        'id': resource_id,
+        'save_action': 'go-metadata'
+    }
+    with timePhase(upload, 'finish'):
+        finish_response = ckanRequest('cloudstorage_finish_multipart', finish_dict, ckan_api_key)
+    if file_path is not None and isUploadMissing(finish_response):
+        # the server no longer has the upload: it was dropped (e.g. expired), or an earlier finish request
+        # has already joined the parts, so check the resource before the journal is discarded
+        finished = isUploadFinished(upload, ckan_api_key)
+        if finished:
+            print('{} has already been joined into the resource file'.format(file_name))
+            finish_response = {'success': True}
+        elif finished is None:
+            print('Error finalizing uploading chunk')
+            if upload['resume']:
+                print('Run the upload again to finish it')
+            return done(False)
+    if finish_response.get('success'):
+        if file_path is not None:
+            removeJournal(file_path)
+        print('All chunks sent to server')
+    else:
+        print('Error finalizing uploading chunk')
+        if file_path is not None and isUploadMissing(finish_response):
+            # the server no longer has the upload and the resource does not hold the file (other errors, e.g.
+            # HTTP 503 or a timeout, keep the journal)
+            print('Discarding upload journal for {}'.format(file_name))
+            removeJournal(file_path)
+        elif file_path is not None and upload['resume']:
+            print('Run the upload again to finish it')
+        return done(False)
+
+    # Update resource
+    data_dict = {
+        'id': resource_id,
+        'multipart_name': file_name,
+        'url': file_name,
+        'size': str(upload['file_size']),
+        'url_type': 'upload'
+    }
+    if not upload['file_hash'] and checksums is not None:
+        with timePhase(upload, 'hash'):
+            upload['file_hash'] = checksums.getFileHash()
+    if upload['file_hash']:
+        data_dict[hash_field] = upload['file_hash']
+    with timePhase(upload, 'patch'):
+        res_update_response = ckanRequest('resource_patch', data_dict, ckan_api_key)
+    if res_update_response.get('success'):
+        print('Resource has been updated.')
+        print(res_update_response)
+    else:
+        print('Unable to finish multipart upload')
+        return done(False)
+
+    return done(True)
+
+
+# Upload the data read from `stream` (any object with a read(size) method, e.g. a CompressedFileReader)
+# as the resource's file, named upload_name. The stream is cut into chunks as it is read, so its total
+# size does not need to be known in advance; size_hint is the size sent when the upload is initiated
+# (the actual size is set on the resource once the upload is finished). Streamed uploads can not be
+# resumed. Returns True if the resource has been updated.
+def uploadStream(resource_id, upload_name, stream, ckan_api_key, size_hint=0, max_workers=None,
+                 file_hash=None):
+    upload = {
+        'resource_id': resource_id,
+        'file_path': None,
+        'file_name': upload_name,
+        'file_hash': file_hash,
+        'resume': False,
+        'skipped': False,
+        'previous_parts': set(),
+        'new_parts': set(),
+        'missing': False,
+        'checksums': None,
+        'phases': {},
+        'start_time': time.monotonic()
+    }
+    init_dict = {
+        'id': resource_id,
+        'name': upload_name,
+        'size': str(size_hint)
+    }
+    with timePhase(upload, 'initiate'):
+        init_response = ckanRequest('cloudstorage_initiate_multipart', init_dict, ckan_api_key)
+    if init_response.get('success'):
+        print('Ready to upload {}\n'.format(upload_name))
+    else:
+        print('Unable to initiate multipart upload')
+        return False
+    upload['upload_id'] = init_response.get('result', {}).get('id')
+
+    # number the chunks as they are cut from the stream
+    chunk_sizes = []
+
+    def streamChunks():
+        for chunk in readInChunks(stream, chunk_size):
+            chunk_sizes.append(len(chunk))
+            yield len(chunk_sizes), chunk
+
+    chunks = streamChunks()
+    try:
+        with timePhase(upload, 'parts'):
+            uploadChunks(resource_id, upload['upload_id'], upload_name, chunks, ckan_api_key, max_workers,
+                         on_part_uploaded=upload['new_parts'].add)
+    finally:
+        chunks.close()
+    upload['chunk_count'] = len(chunk_sizes)
+    upload['file_size'] = sum(chunk_sizes)
+    return finishUpload(upload, ckan_api_key)
+
+
+def ckanUploadFile(resource_id, file_path, ckan_api_key=None, max_workers=None, resume=None, read_mode=None,
+                   read_ahead=None, verify_chunks=None, skip_unchanged=None, compression=None):
+    ckan_api_key = getSetting('ckan_api_key', ckan_api_key)
+    max_workers = getSetting('max_workers', max_workers)
+    read_mode = getSetting('read_mode', read_mode)
+    read_ahead = getSetting('read_ahead', read_ahead)
+    skip_unchanged = getSetting('skip_unchanged', skip_unchanged)
+    compression = getSetting('compression', compression)
+    getSession(max(pool_size, max_workers))
+    # (the size of a compressed file is only known once it has been sent, so its progress has no total)
+    with reportProgress(0 if compression else getFileSize(file_path)) as progress:
+        # Compressed files are compressed while they are uploaded, so their size (and number of chunks) is
+        # only known once the whole file has been sent
+        if compression:
+            file_name = os.path.basename(file_path)
+            file_hash = None
+            if skip_unchanged:
+                file_hash = getFileHash(file_path)
+                if isResourceUnchanged(resource_id, None, file_hash, ckan_api_key):
+                    print('{} has not changed since it was last uploaded - skipping upload'.format(file_name))
+                    progress.advance(os.path.getsize(file_path))
+                    return True
+            compressed_file = CompressedFileReader(file_path, compression)
+            try:
+                return uploadStream(resource_id, file_name + CompressedFileReader.extensions[compression],
+                                    compressed_file, ckan_api_key, os.path.getsize(file_path), max_workers,
+                                    file_hash)
+            finally:
+                compressed_file.close()
+
+        upload = startUpload(resource_id, file_path, ckan_api_key, resume, skip_unchanged, verify_chunks)
+        if upload is None:
+            return False
+        if upload['skipped']:
+            return finishUpload(upload, ckan_api_key)
+        upload_id = upload['upload_id']
+        file_name = upload['file_name']
+        file_size = upload['file_size']
+        file_chunk_size = upload['chunk_size']
+        chunk_count = upload['chunk_count']
+        previous_parts = upload['previous_parts']
+
+        # Read file and upload the chunks that have not been sent yet (up to max_workers chunks at the same time)
+        with open(file_path, 'rb') as upload_file:
+            mapped_file = None
+            positional_file = None
+            if read_mode == 'mmap' and file_size > 0:
+                mapped_file = mmap.mmap(upload_file.fileno(), 0, access=mmap.ACCESS_READ)
+                chunks = readMissingChunksMmap(mapped_file, chunk_count, previous_parts, file_chunk_size)
+            elif read_mode == 'stream':
+                chunks = readMissingChunksStream(file_path, file_size, chunk_count, previous_parts, file_chunk_size)
+            elif read_mode == 'pread':
+                positional_file = PositionalFile(file_path)
+                chunks = readMissingChunksPread(positional_file, file_size, chunk_count, previous_parts, file_chunk_size)
+            else:
+                chunks = readMissingChunks(upload_file, chunk_count, previous_parts, file_chunk_size)
+                if read_ahead > 0:
+                    chunks = readAhead(chunks, read_ahead)
+            try:
+                with timePhase(upload, 'parts'):
+                    uploadChunks(resource_id, upload_id, file_name, chunks, ckan_api_key, max_workers,
+                                 on_part_uploaded=lambda part_number: recordUploadedPart(upload, part_number),
+                                 checksums=upload['checksums'],
+                                 on_upload_missing=lambda: recordUploadMissing(upload))
+            finally:
+                chunks.close()
+                if mapped_file is not None:
+                    mapped_file.close()
+                if positional_file is not None:
+                    positional_file.close()
+
+        return finishUpload(upload, ckan_api_key)
+
+
+# Upload the data produced by an iterable of blocks (bytes or str, e.g. CSV rows from a generator or an
+# R-side pipe) as the resource's file, named upload_name, without saving it to a file first. Parts are cut
+# as the blocks arrive (up to max_workers parts are sent at the same time) and the upload is finished when
+# the iterable ends. size_hint (optional) is the expected size sent when the upload is initiated. Returns
+# True if the resource has been updated.
+def ckanUploadIterable(resource_id, upload_name, blocks, ckan_api_key=None, max_workers=None, size_hint=0):
+    ckan_api_key = getSetting('ckan_api_key', ckan_api_key)
+    max_workers = getSetting('max_workers', max_workers)
+    getSession(max(pool_size, max_workers))
+    with reportProgress(size_hint):
+        stream = IterableReader(blocks)
+        try:
+            return uploadStream(resource_id, upload_name, stream, ckan_api_key, size_hint, max_workers)
+        finally:
+            stream.close()
+
+
+# Limit on the number of bytes being sent at the same time by ckanUploadFiles (a part larger than the
+# limit is let through once nothing else is being sent, so it cannot wait forever)
+class ByteBudget(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.limit)
+            self.in_flight += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+# asyncio engine behind ckanUploadFiles: the multipart upload of each file (initiate, parts, finish,
+# resource update) is a coroutine, and the blocking CKAN requests run in a thread pool
+async def uploadFilesAsync(file_paths, ckan_api_key, max_files, max_parts, max_bytes, read_mode,
+                           resume, skip_unchanged, verify_chunks):
+    loop = asyncio.get_running_loop()
+    file_slots = asyncio.Semaphore(max_files)
+    part_slots = asyncio.Semaphore(max_parts)
+    byte_budget = ByteBudget(max_bytes)
+
+    async def uploadPart(upload, part_number):
+        offset = (part_number - 1) * upload['chunk_size']
+        length = min(upload['chunk_size'], upload['file_size'] - offset)
+        async with part_slots:
+            await byte_budget.acquire(length)
+            try:
+                # stop sending parts of a file once one of its parts has failed
+                if upload['failed']:
+                    return
+                if read_mode == 'read':
+                    chunk = await loop.run_in_executor(executor, readPart, upload['file_path'], offset, length)
+                elif read_mode == 'pread':
+                    chunk = PositionalPartReader(upload['positional_file'], offset, length)
+                else:
+                    chunk = FileWindowReader(upload['file_path'], offset, length)
+                success = await loop.run_in_executor(
+                    executor, uploadChunk, upload['resource_id'], upload['upload_id'], part_number,
+                    upload['file_name'], chunk, ckan_api_key, None, upload['checksums'],
+                    lambda: recordUploadMissing(upload))
+            except Exception as e:
+                print('Error uploading chunk {0} of {1}: {2}'.format(part_number, upload['file_name'], e))
+                success = False
+            finally:
+                await byte_budget.release(length)
+        if success:
+            recordUploadedPart(upload, part_number)
+        else:
+            upload['failed'] = True
+
+    async def uploadFile(resource_id, file_path):
+        async with file_slots:
+            try:
+                upload = await loop.run_in_executor(executor, startUpload, resource_id, file_path,
+                                                    ckan_api_key, resume, skip_unchanged, verify_chunks)
+            except OSError as e:
+                print('Unable to upload {0}: {1}'.format(file_path, e))
+                return False
+            if upload is None:
+                return False
+            if not upload['skipped']:
+                upload['failed'] = False
+                missing_parts = [part_number for part_number in range(1, upload['chunk_count'] + 1)
+                                 if part_number not in upload['previous_parts']]
+                upload['positional_file'] = PositionalFile(file_path) if read_mode == 'pread' else None
+                try:
+                    with timePhase(upload, 'parts'):
+                        await asyncio.gather(*[uploadPart(upload, part_number) for part_number in missing_parts])
+                finally:
+                    if upload['positional_file'] is not None:
+                        upload['positional_file'].close()
+            return await loop.run_in_executor(executor, finishUpload, upload, ckan_api_key)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parts + max_files) as executor:
+        results = await asyncio.gather(*[uploadFile(resource_id, file_path)
+                                         for file_path, resource_id in file_paths.items()])
+    return dict(zip(file_paths, results))
+
+
+# Size of a file in bytes (0 if the file does not exist, so it can still be scheduled and reported as failed)
+def getFileSize(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+# Predicted time in seconds to upload a file of file_size bytes, from the measured request latency and
+# throughput (assumed_throughput until the throughput has been measured) and the chunk size the upload
+# will use (see startUpload)
+def predictUploadSeconds(file_size):
+    with transfer_stats_lock:
+        latency = transfer_stats['latency'] or 0
+        throughput = transfer_stats['throughput'] or assumed_throughput
+    file_chunk_size = pickChunkSize(file_size) if adaptive_chunk_size else chunk_size
+    request_count = math.ceil(float(file_size) / file_chunk_size) + 3 # parts + initiate, finish and resource_patch
+    return latency * request_count + file_size / throughput
+
+
+# Plan a batch of uploads with the longest-processing-time-first rule: files are taken largest first and
+# each one goes to the slot predicted to be free earliest. Returns the planned files of each slot and the
+# predicted makespan (time until the last slot is done) in seconds.
+def planUploadBatch(file_sizes, slots):
+    slot_loads = [(0.0, slot) for slot in range(slots)]
+    slot_files = [[] for slot in range(slots)]
+    for file, file_size in sorted(file_sizes.items(), key=lambda item: item[1], reverse=True):
+        load, slot = heapq.heappop(slot_loads)
+        slot_files[slot].append(file)
+        heapq.heappush(slot_loads, (load + predictUploadSeconds(file_size), slot))
+    return slot_files, max(load for load, slot in slot_loads)
+
+
+# Upload a {file: resource_id} batch (file names are appended to upload_files_location) with `slots`
+# files uploaded at the same time, each with ckanUploadFile (upload_options are passed on to it). Files
+# are handed out largest first to whichever slot is free, so the batch finishes as early as possible;
+# the predicted and actual makespan are printed at the end. Returns a {file: True/False} dict of which
+# resources were updated.
+def ckanUploadBatch(uploads, ckan_api_key=None, upload_files_location='', slots=None, **upload_options):
+    ckan_api_key = getSetting('ckan_api_key', ckan_api_key)
+    slots = max(int(getSetting('upload_slots', slots)), 1)
+    # every slot sends up to max_workers parts at the same time
+    getSession(max(pool_size, slots * int(getSetting('max_workers', upload_options.get('max_workers')))))
+    file_sizes = {file: getFileSize(upload_files_location + file) for file in uploads}
+    slot_files, predicted_makespan = planUploadBatch(file_sizes, slots)
+    print('Uploading {0} files ({1:.1f}MB) with {2} slot(s) - predicted time: {3:.0f} seconds'.format(
+        len(uploads), sum(file_sizes.values()) / 1024 ** 2, slots, predicted_makespan))
+
+    pending = sorted(file_sizes, key=file_sizes.get, reverse=True)
+    pending_lock = threading.Lock()
+    results = {}
+    upload_seconds = {}
+
+    def worker():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                file = pending.pop(0)
+            start_time = time.monotonic()
+            try:
+                results[file] = ckanUploadFile(uploads[file], upload_files_location + file, ckan_api_key,
+                                               **upload_options)
+            except Exception as e:
+                print('Error uploading {0}: {1}'.format(file, e))
+                results[file] = False
+            upload_seconds[file] = time.monotonic() - start_time
+
+    batch_start = time.monotonic()
+    with reportProgress(sum(file_sizes.values())):
+        workers = [threading.Thread(target=worker) for slot in range(min(slots, len(uploads)))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    actual_makespan = time.monotonic() - batch_start
+
+    for file in sorted(upload_seconds, key=upload_seconds.get, reverse=True):
+        print('{0}: {1:.1f}MB in {2:.0f} seconds ({3})'.format(file, file_sizes[file] / 1024 ** 2,
+              upload_seconds[file], 'uploaded' if results[file] else 'failed'))
+    print('Batch finished - predicted time: {0:.0f} seconds, actual time: {1:.0f} seconds'.format(
+        predicted_makespan, actual_makespan))
+    recordMetric({
+        'event': 'batch',
+        'engine': 'ckanUploadBatch',
+        'files': len(uploads),
+        'failed': sum(1 for file in uploads if not results.get(file)),
+        'bytes': sum(file_sizes.values()),
+        'slots': slots,
+        'predicted_seconds': round(predicted_makespan, 3),
+        'seconds': round(actual_makespan, 3)
+    })
+    return {file: results.get(file, False) for file in uploads}
+
+
+# Upload several files to their resources at the same time. uploads is a {file: resource_id} dict like
+# the one in the upload files configuration above (file names are appended to upload_files_location).
+# Up to max_files multipart uploads run at once, sharing a limit of max_parts parts and max_bytes bytes
+# being sent across all of them. Files are read as in ckanUploadFile (read_mode 'mmap' is sent as
+# 'stream', and in 'pread' mode each file is opened once for all its parts). Returns a {file: True/False}
+# dict of which resources were updated.
+def ckanUploadFiles(uploads, ckan_api_key=None, upload_files_location='', max_files=None, max_parts=None,
+                    max_bytes=None, read_mode=None, resume=None, skip_unchanged=None, verify_chunks=None):
+    ckan_api_key = getSetting('ckan_api_key', ckan_api_key)
+    max_files = int(getSetting('max_files_in_flight', max_files))
+    max_parts = int(getSetting('max_parts_in_flight', max_parts))
+    max_bytes = getSetting('max_bytes_in_flight', max_bytes)
+    read_mode = getSetting('read_mode', read_mode)
+    resume = getSetting('resume_uploads', resume)
+    skip_unchanged = getSetting('skip_unchanged', skip_unchanged)
+    verify_chunks = getSetting('verify_chunks', verify_chunks)
+    getSession(max(pool_size, max_parts + max_files))
+    # start the largest files first, so a large file at the end of the list does not set the total time
+    file_paths = {upload_files_location + file: resource_id for file, resource_id in uploads.items()}
+    file_paths = dict(sorted(file_paths.items(), key=lambda item: getFileSize(item[0]), reverse=True))
+    total_bytes = sum(getFileSize(file_path) for file_path in file_paths)
+    batch_start = time.monotonic()
+    with reportProgress(total_bytes):
+        results = asyncio.run(uploadFilesAsync(file_paths, ckan_api_key, max_files, max_parts, max_bytes,
+                                               read_mode, resume, skip_unchanged, verify_chunks))
+    results = {file: results[upload_files_location + file] for file in uploads}
+    failed_files = [file for file in uploads if not results[file]]
+    print('Uploaded {0} of {1} files'.format(len(uploads) - len(failed_files), len(uploads)))
+    if failed_files:
+        print('Failed: {}'.format(', '.join(failed_files)))
+    recordMetric({
+        'event': 'batch',
+        'engine': 'ckanUploadFiles',
+        'files': len(uploads),
+        'failed': len(failed_files),
+        'bytes': total_bytes,
+        'max_files': max_files,
+        'max_parts': max_parts,
+        'seconds': round(time.monotonic() - batch_start, 3)
+    })
+    return results
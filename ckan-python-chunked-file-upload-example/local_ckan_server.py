@@ -0,0 +1,332 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from requests_toolbelt.multipart.decoder import MultipartDecoder
+
+# Local stand-in for the CKAN API actions used by the chunked uploader (cloudstorage multipart upload,
+# resource_patch, resource_show and datastore_create), so uploads can be tested and timed without
+# sending anything to the portal. Uploaded files are stored on disk in storage_location. Point the
+# uploader at it with ckan_base = 'http://127.0.0.1:5000' (any API key is accepted unless api_key is set).
+
+### CONFIGURATION ###
+host = '127.0.0.1' # address to listen on
+port = 5000 # port to listen on (0 picks a free port)
+storage_location = 'local_ckan_storage/' # folder where uploaded parts, finished files and resource metadata are stored
+latency = 0 # seconds added before every response (e.g. 0.05 to imitate the round trip to the portal)
+bandwidth = None # maximum MB/s received across all requests together, or None for no limit
+failure_rate = 0 # fraction of requests (0 to 1) answered with failure_status instead of being processed
+failure_status = 503 # HTTP status code of the injected failures
+failure_actions = None # actions the injected failures apply to (e.g. ['cloudstorage_upload_multipart']), or None for all actions
+api_key = None # API key the requests must send in the X-CKAN-API-Key header, or None to accept any key
+random_seed = None # seed for the injected failures, so a run can be repeated exactly
+log_requests = True # print a line for every request
+
+
+# Shared server state: resource metadata (saved to resources.json), multipart uploads in progress and
+# the time the bandwidth limit lets the next block of data in
+resources = {}
+multipart_uploads = {}
+state_lock = threading.Lock()
+bandwidth_next_time = 0.0
+bandwidth_lock = threading.Lock()
+failure_random = random.Random(random_seed)
+
+
+# Folder of a resource's stored data
+def getResourceFolder(resource_id):
+    return os.path.join(storage_location, resource_id)
+
+
+# Load the resource metadata saved by an earlier run of the server
+def loadResources():
+    resources_path = os.path.join(storage_location, 'resources.json')
+    if os.path.exists(resources_path):
+        with open(resources_path) as resources_file:
+            resources.update(json.load(resources_file))
+
+
+# Save the resource metadata (call with state_lock held)
+def saveResources():
+    resources_path = os.path.join(storage_location, 'resources.json')
+    with open(resources_path + '.tmp', 'w') as resources_file:
+        json.dump(resources, resources_file, indent=2)
+    os.replace(resources_path + '.tmp', resources_path)
+
+
+# Wait until `size` more bytes can be received without going over the bandwidth limit
+def waitForBandwidth(size):
+    global bandwidth_next_time
+    if not bandwidth:
+        return
+    with bandwidth_lock:
+        now = time.monotonic()
+        start_time = max(bandwidth_next_time, now)
+        bandwidth_next_time = start_time + size / (bandwidth * 1024 ** 2)
+        delay = bandwidth_next_time - now
+    time.sleep(delay)
+
+
+# Whether to answer a request for `action` with an injected failure
+def isInjectedFailure(action):
+    if not failure_rate or (failure_actions is not None and action not in failure_actions):
+        return False
+    with state_lock:
+        return failure_random.random() < failure_rate
+
+
+# Error response in the format CKAN uses
+def ckanError(error_type, message):
+    return {'success': False, 'error': {'__type': error_type, 'message': message}}
+
+
+# Get (or create) the metadata of a resource (call with state_lock held)
+def getResource(resource_id):
+    if resource_id not in resources:
+        resources[resource_id] = {'id': resource_id, 'url_type': 'upload'}
+    return resources[resource_id]
+
+
+# cloudstorage_initiate_multipart: start a multipart upload of `name` to the resource
+def initiateMultipart(data):
+    upload_id = uuid.uuid4().hex
+    with state_lock:
+        getResource(data['id'])
+        multipart_uploads[upload_id] = {
+            'resource_id': data['id'],
+            'name': data.get('name'),
+            'size': data.get('size'),
+            'parts': {}
+        }
+    os.makedirs(os.path.join(getResourceFolder(data['id']), 'parts', upload_id), exist_ok=True)
+    return 200, {'success': True, 'result': {'id': upload_id, 'name': data.get('name')}}
+
+
+# cloudstorage_upload_multipart: store one part of a multipart upload
+def uploadMultipart(data):
+    with state_lock:
+        upload = multipart_uploads.get(data.get('uploadId'))
+    if upload is None:
+        return 404, ckanError('Not Found Error', 'Multipart upload not found')
+    part_number = int(data['partNumber'])
+    part = data['upload']
+    part_path = os.path.join(getResourceFolder(upload['resource_id']), 'parts', data['uploadId'], str(part_number))
+    with open(part_path, 'wb') as part_file:
+        part_file.write(part)
+    etag = hashlib.md5(part).hexdigest()
+    with state_lock:
+        upload['parts'][part_number] = len(part)
+    return 200, {'success': True, 'result': {'partNumber': part_number, 'ETag': '"{}"'.format(etag)}}
+
+
+# cloudstorage_finish_multipart: join the parts of a multipart upload into the resource's file
+def finishMultipart(data):
+    with state_lock:
+        upload = multipart_uploads.get(data.get('uploadId'))
+    if upload is None:
+        return 404, ckanError('Not Found Error', 'Multipart upload not found')
+    part_numbers = sorted(upload['parts'])
+    if part_numbers != list(range(1, len(part_numbers) + 1)):
+        return 409, ckanError('Validation Error', 'Missing parts: {}'.format(
+            sorted(set(range(1, max(part_numbers or [0]) + 1)) - set(part_numbers))))
+    resource_folder = getResourceFolder(upload['resource_id'])
+    parts_folder = os.path.join(resource_folder, 'parts', data['uploadId'])
+    file_path = os.path.join(resource_folder, upload['name'])
+    with open(file_path, 'wb') as resource_file:
+        for part_number in part_numbers:
+            part_path = os.path.join(parts_folder, str(part_number))
+            with open(part_path, 'rb') as part_file:
+                while True:
+                    block = part_file.read(1024 * 1024)
+                    if not block:
+                        break
+                    resource_file.write(block)
+            os.remove(part_path)
+    os.rmdir(parts_folder)
+    with state_lock:
+        del multipart_uploads[data['uploadId']]
+        resource = getResource(upload['resource_id'])
+        resource.update({
+            'url': upload['name'],
+            'size': os.path.getsize(file_path),
+            'last_modified': time.strftime('%Y-%m-%dT%H:%M:%S')
+        })
+        saveResources()
+    return 200, {'success': True, 'result': {'commited': True}}
+
+
+# resource_patch: update the given fields of the resource's metadata
+def resourcePatch(data):
+    with state_lock:
+        resource = getResource(data['id'])
+        resource.update({key: value for key, value in data.items() if not isinstance(value, bytes)})
+        resource['metadata_modified'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        saveResources()
+        return 200, {'success': True, 'result': dict(resource)}
+
+
+# resource_show: the resource's metadata
+def resourceShow(data):
+    with state_lock:
+        if data.get('id') not in resources:
+            return 404, ckanError('Not Found Error', 'Not found')
+        return 200, {'success': True, 'result': dict(resources[data['id']])}
+
+
+# datastore_create: create the resource's datastore table (fields) and append the records to it
+def datastoreCreate(data):
+    resource_id = data.get('resource_id') or data.get('resource', {}).get('id')
+    if not resource_id:
+        return 409, ckanError('Validation Error', 'resource_id is missing')
+    records = data.get('records') or []
+    if isinstance(records, str):
+        records = json.loads(records)
+    fields = data.get('fields') or []
+    if isinstance(fields, str):
+        fields = json.loads(fields)
+    os.makedirs(getResourceFolder(resource_id), exist_ok=True)
+    with state_lock:
+        resource = getResource(resource_id)
+        if fields:
+            resource['datastore_fields'] = fields
+        resource['datastore_active'] = True
+        with open(os.path.join(getResourceFolder(resource_id), 'datastore.jsonl'), 'a') as datastore_file:
+            for record in records:
+                datastore_file.write(json.dumps(record) + '\n')
+        saveResources()
+        return 200, {'success': True, 'result': {'resource_id': resource_id, 'fields': resource.get('datastore_fields', []),
+                                                 'method': 'insert'}}
+
+
+actions = {
+    'cloudstorage_initiate_multipart': initiateMultipart,
+    'cloudstorage_upload_multipart': uploadMultipart,
+    'cloudstorage_finish_multipart': finishMultipart,
+    'resource_patch': resourcePatch,
+    'resource_show': resourceShow,
+    'datastore_create': datastoreCreate
+}
+
+
+# Handles POST (and GET with query string parameters) requests to /api/action/<action>
+class CkanRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if log_requests:
+            print('{0} - {1}'.format(self.address_string(), format % args))
+
+    # Read the request body in blocks, at the speed allowed by the bandwidth limit
+    def readBody(self):
+        blocks = []
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                blocks.append(self.readBlocks(size))
+                self.rfile.readline()
+        else:
+            blocks.append(self.readBlocks(int(self.headers.get('Content-Length') or 0)))
+        return b''.join(blocks)
+
+    def readBlocks(self, size):
+        blocks = []
+        while size > 0:
+            block = self.rfile.read(min(size, 64 * 1024))
+            if not block:
+                break
+            waitForBandwidth(len(block))
+            blocks.append(block)
+            size -= len(block)
+        return b''.join(blocks)
+
+    # Request parameters from a multipart/form-data, JSON or URL-encoded body (file fields are kept as bytes)
+    def parseBody(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            data = {}
+            for part in MultipartDecoder(body, content_type).parts:
+                disposition = part.headers.get(b'Content-Disposition', b'').decode()
+                name = disposition.split('name="', 1)[1].split('"', 1)[0]
+                data[name] = part.content if 'filename=' in disposition else part.content.decode()
+            return data
+        if content_type.startswith('application/json'):
+            return json.loads(body.decode() or '{}')
+        return dict(parse_qsl(body.decode()))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.handleAction(url.path, dict(parse_qsl(url.query)))
+
+    def do_POST(self):
+        body = self.readBody()
+        try:
+            data = self.parseBody(body)
+        except (ValueError, IndexError) as e:
+            self.sendJson(400, ckanError('Validation Error', 'Unable to parse request: {}'.format(e)))
+            return
+        self.handleAction(self.path.split('?', 1)[0], data)
+
+    def handleAction(self, path, data):
+        action = path.rstrip('/').rsplit('/', 1)[-1]
+        if latency:
+            time.sleep(latency)
+        if not path.startswith('/api/') or action not in actions:
+            self.sendJson(400, ckanError('Not Found Error', 'Action name not known: {}'.format(action)))
+        elif api_key is not None and self.headers.get('X-CKAN-API-Key', self.headers.get('Authorization')) != api_key:
+            self.sendJson(403, ckanError('Authorization Error', 'Access denied'))
+        elif isInjectedFailure(action):
+            self.sendJson(failure_status, ckanError('Injected Error', 'Injected failure'))
+        else:
+            try:
+                status, response = actions[action](data)
+            except KeyError as e:
+                status, response = 409, ckanError('Validation Error', 'Missing value: {}'.format(e))
+            self.sendJson(status, response)
+
+    def sendJson(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Create the server with the current configuration (storage folder, stored resources and failure seed)
+def createServer():
+    os.makedirs(storage_location, exist_ok=True)
+    loadResources()
+    failure_random.seed(random_seed)
+    server = ThreadingHTTPServer((host, port), CkanRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+# Start the server in a background thread (e.g. from a test or benchmark script) and return it; its
+# address is 'http://{0}:{1}'.format(*server.server_address). Stop it with server.shutdown().
+def startServer():
+    server = createServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+
+#### MAIN FUNCTION ###
+if __name__ == "__main__":
+    server = createServer()
+    print('Local CKAN server running at http://{0}:{1} (files stored in {2})'.format(
+        host, server.server_address[1], os.path.abspath(storage_location)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping server')
+        server.server_close()
@@ -0,0 +1,281 @@
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import resource # peak memory on Linux / macOS
+except ImportError:
+    resource = None
+try:
+    import psutil # optional - peak memory on Windows
+except ImportError:
+    psutil = None
+
+# Benchmark of the chunked uploader (ckan_chunked_upload.py) against the local stand-in CKAN server
+# (local_ckan_server.py): synthetic files with the shape and (scaled) size of the CEDEN and SMARTS
+# outputs are uploaded with every combination of chunk size and number of parallel chunks, each in its
+# own process, and the upload speed (MB/s), peak memory and CPU time of each configuration are reported.
+# Run it (python upload_benchmark.py, or python upload_benchmark.py <folder> to use another benchmark_location)
+# after changing the upload code and compare with the previous run.
+
+### CONFIGURATION ###
+benchmark_location = os.path.join(tempfile.gettempdir(), 'ckan_upload_benchmark') # folder for the synthetic files, the local server's storage and the results (outside the repository)
+size_scale = 0.05 # fraction of the real file sizes to generate (1 for full size - needs several GB of disk space)
+chunk_sizes = [1024 * 1024 * 8, 1024 * 1024 * 32, 1024 * 1024 * 64] # chunk sizes to compare
+worker_counts = [1, 4, 8] # numbers of chunks uploaded at the same time (max_workers) to compare
+benchmark_read_mode = 'read' # read_mode of the uploader ('read', 'mmap', 'stream' or 'pread')
+server_latency = 0.02 # seconds the local server adds to every response
+server_bandwidth = None # MB/s limit of the local server, or None for no limit
+server_failure_rate = 0 # fraction of part uploads the local server fails (to include retries in the benchmark)
+results_file = 'upload_benchmark_results.json' # results of the run, saved in benchmark_location
+baseline_file = None # results file of an earlier run to compare with (e.g. a copy of an earlier results_file), or None
+regression_threshold = 0.10 # report configurations that are more than 10% slower than the baseline
+
+
+# Columns of the synthetic files, with the kind of values they hold ('text', 'code', 'date', 'number' or 'coordinate')
+ceden_columns = [
+    ('Program', 'text'), ('ParentProject', 'text'), ('Project', 'text'), ('StationName', 'text'),
+    ('StationCode', 'code'), ('SampleDate', 'date'), ('CollectionTime', 'code'), ('LocationCode', 'code'),
+    ('CollectionDepth', 'number'), ('UnitCollectionDepth', 'code'), ('SampleTypeCode', 'code'),
+    ('CollectionReplicate', 'number'), ('ResultsReplicate', 'number'), ('LabBatch', 'code'),
+    ('LabSampleID', 'code'), ('MatrixName', 'code'), ('MethodName', 'code'), ('Analyte', 'text'),
+    ('Unit', 'code'), ('Result', 'number'), ('Observation', 'text'), ('MDL', 'number'), ('RL', 'number'),
+    ('ResultQualCode', 'code'), ('QACode', 'code'), ('BatchVerification', 'code'),
+    ('ComplianceCode', 'code'), ('SampleComments', 'text'), ('CollectionComments', 'text'),
+    ('ResultsComments', 'text'), ('BatchComments', 'text'), ('EventCode', 'code'), ('ProtocolCode', 'code'),
+    ('SampleAgency', 'text'), ('GroupSamples', 'code'), ('CollectionMethodName', 'text'),
+    ('Latitude', 'coordinate'), ('Longitude', 'coordinate'), ('CollectionDeviceDescription', 'text'),
+    ('CalibrationDate', 'date'), ('PrepPreservationName', 'code'), ('PrepPreservationDate', 'date'),
+    ('DigestExtractMethod', 'code'), ('DigestExtractDate', 'date'), ('AnalysisDate', 'date'),
+    ('DilutionFactor', 'number'), ('ExpectedValue', 'number'), ('LabAgency', 'text'),
+    ('SubmittingAgency', 'text'), ('SubmissionCode', 'code'), ('OccupationMethod', 'text'),
+    ('StartingBank', 'code'), ('DistanceFromBank', 'number'), ('UnitDistanceFromBank', 'code'),
+    ('StreamWidth', 'number'), ('UnitStreamWidth', 'code'), ('StationWaterDepth', 'number'),
+    ('UnitStationWaterDepth', 'code'), ('HydroMod', 'code'), ('HydroModLoc', 'code'),
+    ('LocationDetailWQComments', 'text'), ('ChannelWidth', 'number'), ('UpstreamLength', 'number'),
+    ('DownStreamLength', 'number'), ('TotalReach', 'number'), ('LocationDetailBAComments', 'text'),
+    ('SampleID', 'code'), ('Datum', 'code'), ('DataQuality', 'text'), ('DataQualityIndicator', 'text')
+]
+smarts_columns = [
+    ('WDID', 'code'), ('APP_ID', 'code'), ('PLACE_NAME', 'text'), ('PLACE_ADDRESS', 'text'),
+    ('PLACE_CITY', 'text'), ('PLACE_ZIP', 'code'), ('PLACE_COUNTY', 'text'), ('PLACE_LATITUDE', 'coordinate'),
+    ('PLACE_LONGITUDE', 'coordinate'), ('REGION', 'code'), ('STATUS', 'code'), ('REPORTING_YEAR', 'code'),
+    ('EVENT_TYPE', 'code'), ('SAMPLE_ID', 'code'), ('SAMPLE_DATE', 'date'), ('DISCHARGE_START_DATE', 'date'),
+    ('PARAMETER', 'text'), ('RESULT_QUALIFIER', 'code'), ('RESULT', 'number'), ('UNITS', 'code'),
+    ('MDL', 'number'), ('RL', 'number'), ('ANALYTICAL_METHOD', 'code'), ('DISCHARGE_LOCATION', 'text'),
+    ('SAMPLE_TYPE', 'code'), ('CERTIFIER_NAME', 'text'), ('CERTIFIED_DATE', 'date')
+]
+
+# Synthetic files: name -> (columns, real size in MB). CEDEN yearly files, a CEDEN bulk file and the seven SMARTS exports.
+benchmark_files = {
+    'WaterChemistryData_year-2023.csv': (ceden_columns, 350),
+    'WaterChemistryData_year-2022.csv': (ceden_columns, 420),
+    'ToxicityData_year-2023.csv': (ceden_columns, 60),
+    'TissueData_year-2023.csv': (ceden_columns, 25),
+    'WaterChemistryData_prior_to_2000.csv': (ceden_columns, 2600),
+    'Industrial_Ad_Hoc_Reports_-_Parameter_Data.csv': (smarts_columns, 900),
+    'Industrial_Application_Specific_Data.csv': (smarts_columns, 40),
+    'Construction_Ad_Hoc_Reports_-_Parameter_Data.csv': (smarts_columns, 300),
+    'Construction_Application_Specific_Data.csv': (smarts_columns, 120),
+    'Inspections.csv': (smarts_columns, 60),
+    'Violations.csv': (smarts_columns, 10),
+    'Enforcement_Actions.csv': (smarts_columns, 15)
+}
+
+
+# Random value of the given kind, for a synthetic row
+def syntheticValue(value_random, kind):
+    if kind == 'number':
+        return '{:.3f}'.format(value_random.lognormvariate(0, 2))
+    if kind == 'coordinate':
+        return '{:.6f}'.format(value_random.uniform(32.5, 42))
+    if kind == 'date':
+        return '{0}-{1:02d}-{2:02d}'.format(value_random.randint(1990, 2024), value_random.randint(1, 12),
+                                            value_random.randint(1, 28))
+    if kind == 'code':
+        return ''.join(value_random.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789')
+                       for i in range(value_random.randint(3, 10)))
+    return ' '.join(value_random.choice(['Creek', 'River', 'Bay', 'Lake', 'Monitoring', 'Program', 'Total',
+                                          'Dissolved', 'Water', 'Sediment', 'Station', 'Regional', 'Board',
+                                          'Field', 'Sample', 'County', 'North', 'South', 'Upper', 'Lower'])
+                    for i in range(value_random.randint(0, 6)))
+
+
+# Write a synthetic CSV of about file_size bytes (rows are generated in blocks, which are repeated with a
+# few fresh rows each so the file does not compress much better than the real data)
+def writeSyntheticFile(file_path, columns, file_size, seed=0):
+    value_random = random.Random(seed)
+    block_rows = 2000
+    with open(file_path, 'w', newline='', encoding='utf8') as synthetic_file:
+        writer = csv.writer(synthetic_file, lineterminator='\n')
+        writer.writerow([name for name, kind in columns])
+        rows = [[syntheticValue(value_random, kind) for name, kind in columns] for i in range(block_rows)]
+        while synthetic_file.tell() < file_size:
+            for i in range(block_rows // 20):
+                rows[value_random.randrange(block_rows)] = [syntheticValue(value_random, kind) for name, kind in columns]
+            value_random.shuffle(rows)
+            for start in range(0, block_rows, 100):
+                writer.writerows(rows[start:start + 100])
+                if synthetic_file.tell() >= file_size:
+                    break
+
+
+# Create the synthetic files that are missing, or all of them if size_scale has changed since they were written
+def prepareBenchmarkFiles():
+    files_location = os.path.join(benchmark_location, 'files')
+    os.makedirs(files_location, exist_ok=True)
+    scale_path = os.path.join(files_location, 'size_scale.json')
+    previous_scale = None
+    if os.path.exists(scale_path):
+        with open(scale_path) as scale_file:
+            previous_scale = json.load(scale_file)
+    file_paths = []
+    for count, (file_name, (columns, size_mb)) in enumerate(benchmark_files.items()):
+        file_path = os.path.join(files_location, file_name)
+        file_size = int(size_mb * 1024 ** 2 * size_scale)
+        if previous_scale != size_scale or not os.path.exists(file_path):
+            print('Writing {0} ({1:.1f}MB)'.format(file_name, file_size / 1024 ** 2))
+            writeSyntheticFile(file_path, columns, file_size, seed=count)
+        file_paths.append(file_path)
+    with open(scale_path, 'w') as scale_file:
+        json.dump(size_scale, scale_file)
+    return file_paths
+
+
+# Peak memory use of this process in MB (None if it can not be measured)
+def getPeakMemory():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB everywhere else
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / 1024 ** 2
+    return None
+
+
+# Upload all the benchmark files with one configuration (runs in its own process, so the peak memory is
+# that of this configuration only) and put the measurements on the results queue
+def runConfiguration(ckan_base, file_paths, configuration, results):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ckan_chunked_upload
+    ckan_chunked_upload.configure(ckan_base=ckan_base, chunk_size=configuration['chunk_size'], progress_mode='silent',
+                                  retry_policy=dict(ckan_chunked_upload.retry_policy, backoff=0.1, max_backoff=1))
+    start_time = time.monotonic()
+    start_cpu = time.process_time()
+    uploaded = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for count, file_path in enumerate(file_paths):
+            if ckan_chunked_upload.ckanUploadFile('benchmark-resource-{}'.format(count), file_path, 'benchmark-key',
+                                                  max_workers=configuration['max_workers'], resume=False,
+                                                  read_mode=benchmark_read_mode):
+                uploaded += 1
+    seconds = time.monotonic() - start_time
+    total_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+    results.put(dict(configuration,
+                     files=len(file_paths),
+                     uploaded=uploaded,
+                     mb=round(total_bytes / 1024 ** 2, 1),
+                     seconds=round(seconds, 2),
+                     mb_per_second=round(total_bytes / 1024 ** 2 / seconds, 2),
+                     cpu_seconds=round(time.process_time() - start_cpu, 2),
+                     peak_memory_mb=None if getPeakMemory() is None else round(getPeakMemory(), 1)))
+
+
+# Print the results of a run as a table, with the change in MB/s from the baseline run if there is one,
+# and return the configurations that got slower by more than regression_threshold
+def reportResults(run_results, baseline_results=None):
+    baseline = {(result['chunk_size'], result['max_workers']): result for result in baseline_results or []}
+    regressions = []
+    print('\n{0:>10} {1:>8} {2:>9} {3:>8} {4:>9} {5:>13} {6:>12}'.format(
+        'chunk MB', 'workers', 'MB/s', 'CPU s', 'peak MB', 'vs baseline', 'uploaded'))
+    for result in run_results:
+        change = ''
+        previous = baseline.get((result['chunk_size'], result['max_workers']))
+        if previous:
+            ratio = result['mb_per_second'] / previous['mb_per_second'] - 1
+            change = '{:+.0%}'.format(ratio)
+            if ratio < -regression_threshold:
+                regressions.append(result)
+                change += ' !'
+        print('{0:>10.0f} {1:>8} {2:>9.2f} {3:>8.2f} {4:>9} {5:>13} {6:>12}'.format(
+            result['chunk_size'] / 1024 ** 2, result['max_workers'], result['mb_per_second'],
+            result['cpu_seconds'], 'n/a' if result['peak_memory_mb'] is None else result['peak_memory_mb'],
+            change, '{0}/{1}'.format(result['uploaded'], result['files'])))
+    return regressions
+
+
+# Run the benchmark: every combination of chunk_sizes and worker_counts. Returns the results (also saved
+# as JSON to results_file in benchmark_location).
+def runBenchmark():
+    import local_ckan_server
+    file_paths = prepareBenchmarkFiles()
+
+    # the local server runs in this process, so its own CPU and memory use are not counted
+    local_ckan_server.storage_location = os.path.join(benchmark_location, 'server')
+    local_ckan_server.port = 0
+    local_ckan_server.latency = server_latency
+    local_ckan_server.bandwidth = server_bandwidth
+    local_ckan_server.failure_rate = server_failure_rate
+    local_ckan_server.failure_actions = ['cloudstorage_upload_multipart']
+    local_ckan_server.random_seed = 0
+    local_ckan_server.log_requests = False
+    shutil.rmtree(local_ckan_server.storage_location, ignore_errors=True)
+    server = local_ckan_server.startServer()
+    ckan_base = 'http://{0}:{1}'.format(*server.server_address)
+
+    run_results = []
+    try:
+        for configuration_chunk_size in chunk_sizes:
+            for max_workers in worker_counts:
+                configuration = {'chunk_size': configuration_chunk_size, 'max_workers': max_workers}
+                print('Uploading {0} files with {1:.0f}MB chunks, {2} at a time'.format(
+                    len(file_paths), configuration_chunk_size / 1024 ** 2, max_workers))
+                results = multiprocessing.Queue()
+                process = multiprocessing.Process(target=runConfiguration,
+                                                  args=(ckan_base, file_paths, configuration, results))
+                process.start()
+                result = None
+                while result is None and (process.is_alive() or not results.empty()):
+                    try:
+                        result = results.get(timeout=1)
+                    except queue.Empty:
+                        pass
+                process.join()
+                if result is None:
+                    print('Benchmark process failed (exit code {})'.format(process.exitcode))
+                else:
+                    run_results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(os.path.join(benchmark_location, results_file), 'w') as run_file:
+        json.dump(run_results, run_file, indent=2)
+    baseline_results = None
+    if baseline_file and os.path.exists(baseline_file):
+        with open(baseline_file) as previous_file:
+            baseline_results = json.load(previous_file)
+    regressions = reportResults(run_results, baseline_results)
+    if regressions:
+        print('\n{} configuration(s) are more than {:.0%} slower than the baseline'.format(
+            len(regressions), regression_threshold))
+    return run_results
+
+
+
+
+#### MAIN FUNCTION ###
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if len(sys.argv) > 1:
+        benchmark_location = sys.argv[1]
+    print('Benchmark files and results are in {}'.format(os.path.abspath(benchmark_location)))
+    runBenchmark()